@@ -1,16 +1,28 @@
-import datetime
-import os
+import asyncio
 import re
+import threading
 import time
+from collections import Counter, deque
 
 import requests as r
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
 
+from code.auth import AuthManager
+from code.config import BotConfig
 from code.db import DB
+from code.events import EventBus, PayoutEvent, PayoutEventType
+from code.journal import ClaimJournal
 from code.logger import Logger
 from code.models import Payout, PayoutActionEnum, Bot
+from code.planner import ClaimPlanner
+from code.polling import PageSizer, split_windows
+from code.reminders import ReminderScheduler
 from code.settings import Settings
+from code.snapshot import PayoutsSnapshot, extract_end_time
+from code.stream import JSONArrayStream
 from code.tg import Tg
+from code.webstats import WebStats
 
 
 class API:
@@ -19,17 +31,28 @@ class API:
     db: DB
     tg: Tg
     logger: Logger
+    auth_manager: AuthManager
+    planner: ClaimPlanner
+    events: EventBus
+    snapshot: PayoutsSnapshot
+    reminders: ReminderScheduler
 
-    claimed_payouts = set()
+    # operation_id забранных платежей, по которым еще не отправлено уведомление, и время постановки в очередь
+    claimed_payouts: dict[str, float] = {}
 
     auth_error_count: int = 0
     claimed_payouts_count: int | None = None
+    # Кол-во забранных платежей остальных ботов: значение из БД + наши успешные claim
+    bots_claimed_counts: dict[int, int] | None = None
 
     base_url = 'https://api.turcode.app'
     headers = {
         'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36',
     }
     is_auth: bool = False
+    _poll_started: float = 0.0
+    # Сколько опрос в потоковом режиме простоял на yield, пока снаружи забирали кандидатов
+    _poll_paused: float = 0.0
 
     def __init__(self, session: r.Session, settings: Settings, db: DB, tg: Tg, logger: Logger):
         self.session = session
@@ -39,12 +62,55 @@ class API:
         self.tg.api = self
         self.logger = logger
 
+        self.planner = ClaimPlanner()
+        self.page_sizer = PageSizer()
+        self.webstats = WebStats(self)
+        self.journal = ClaimJournal(settings)
+        self._page_truncated = False
+        # Сколько опросов подряд страница упиралась в длину
+        self._truncated_polls = 0
+        # snapshot.claimed_total на момент последней записи кол-ва забранных в БД
+        self._synced_claimed_total = 0
+        # Брони слотов, которые надо вернуть в БД, по id бота; возвращаются пачкой в фоне
+        self._pending_releases = Counter()
+        self._release_task: asyncio.Task | None = None
+        # Брони, не уложившиеся в claim_reserve_timeout: если они все же закоммитятся, их надо вернуть
+        self._late_reservations: set[asyncio.Task] = set()
+        # До этого времени брони в БД не берем, лимиты проверяем только по памяти
+        self._reserve_paused_until = 0.0
+        self.auth_manager = AuthManager(self)
+        self.auth_manager.sessions[self.db.cur_bot.id] = session
         if self.db.cur_bot.auth_cookie:
+            self.auth_manager.set_cookie(self.db.cur_bot, self.db.cur_bot.auth_cookie)
             self.is_auth = True
 
         logger.info(f'<{settings.bot_name}> API initialized')
 
-        self.time_ending_notified_payouts = []
+        self.bots_claimed_counts = {}
+        # Время наших успешных claim по чужим ботам и значение из БД на момент последней сверки
+        self._own_claims: dict[int, deque[float]] = {}
+        self._synced_counts: dict[int, int] = {}
+        self.claimed_payouts = {}
+        self._claimed_lock = threading.Lock()
+
+        self.events = EventBus()
+        self.snapshot = PayoutsSnapshot(self.events)
+        self.reminders = ReminderScheduler()
+        self._candidates = []
+        # Время первого появления платежа в опросе, переживает discard и повторные попытки
+        self._first_seen: dict[str, float] = {}
+        # Платежи, которые не подошли ни одному боту по сумме или банку. Они остаются в снимке
+        # и не разбираются на каждом опросе, а пересматриваются, когда меняется конфиг ботов
+        self._rejected_ids: set[str] = set()
+        self._rejected_config = None
+        # trace_id забранных платежей до отправки уведомления, ключ - operation_id
+        self._operation_traces: dict[str, str] = {}
+        self._poll_trace_id = None
+
+        self.events.subscribe(PayoutEventType.NEW, self._on_new_payout)
+        self.events.subscribe(PayoutEventType.CLAIMED, self._on_claimed_payout)
+        self.events.subscribe(PayoutEventType.DISAPPEARED, self._on_disappeared_payout)
+        self.events.subscribe(PayoutEventType.EXPIRING, self._on_expiring_payout)
 
     # Словарь переводим в читаемую строку
     def dict_to_str(self, dict_item):
@@ -69,92 +135,157 @@ class API:
             return None
 
     async def check_claimed_payouts(self):
-        async with self.settings.db_session() as session:
-            claimed_payouts = self.claimed_payouts.copy()
-            self.claimed_payouts = set()
-            for operation_id in claimed_payouts:
-                payouts = await Payout.get_not_gained_by_operation_id(session, operation_id)
-                if not payouts:
-                    continue
-
-                for payout in payouts:
-                    await payout.set_is_gained_and_notified(session, True)
-
-                payout = payouts[0]
-                success_msg = (
-                    f'Платеж забран\n'
-                    f'Сумма - 💰{payout.amount}💰\n'
-                    f'Карта - 💸{payout.card}💸'
-                )
-
-                if len(payouts) > 1:
-                    success_msg += '\n\n‼️Кажется, этот платеж уже забирался‼️'
+        with self._claimed_lock:
+            claimed_payouts, self.claimed_payouts = self.claimed_payouts, {}
 
-                self.settings.notifications.add_to_all(success_msg)
-            await session.commit()
+        now_time = time.time()
+        done = set()
+        try:
+            async with self.settings.db_session() as session:
+                for operation_id, queued_at in claimed_payouts.items():
+                    payouts = await Payout.get_not_gained_by_operation_id(session, operation_id)
+                    if not payouts:
+                        # Строка могла еще не доехать из журнала - ждем, но не бесконечно
+                        if now_time - queued_at >= self.settings.claimed_notify_max_age:
+                            done.add(operation_id)
+                            self._operation_traces.pop(operation_id, None)
+                            self.settings.metrics.inc('notify.claimed_expired')
+                        continue
+
+                    for payout in payouts:
+                        await payout.set_is_gained_and_notified(session, True)
+
+                    payout = payouts[0]
+                    success_msg = (
+                        f'Платеж забран\n'
+                        f'Сумма - 💰{payout.amount}💰\n'
+                        f'Карта - 💸{payout.card}💸'
+                    )
+
+                    if len(payouts) > 1:
+                        success_msg += '\n\n‼️Кажется, этот платеж уже забирался‼️'
+
+                    # Спан notify откроется при реальной отправке в Telegram
+                    trace_id = self._operation_traces.pop(operation_id, None)
+                    self.settings.notifications.add_to_all(success_msg, trace_id=trace_id)
+                    done.add(operation_id)
+                await session.commit()
+        finally:
+            # Неотправленные, в том числе из-за ошибки БД, проверим на следующем круге
+            with self._claimed_lock:
+                for operation_id, queued_at in claimed_payouts.items():
+                    if operation_id not in done:
+                        self.claimed_payouts.setdefault(operation_id, queued_at)
 
     async def update_bot_claimed_payouts_count(self):
-        async with self.settings.db_session() as session:
-            claimed_payouts_count = self.claimed_payouts_count
-            if claimed_payouts_count is None:
-                claimed_payouts_count = 0
-            await self.db.cur_bot.set_claimed_payouts_count(session, claimed_payouts_count)
-
-    async def auth(self, bot: Bot = None) -> str | None:
-        if bot is None:
-            bot = self.db.cur_bot
-
-        # Предотвращаем бесконечную авторизацию
-        if bot.turcode_login is None or bot.turcode_pass is None:
+        # Кол-во со страницы пишем как есть, а брони других процессов и свои еще не
+        # видные на странице не затираем - снимаем только те, что в нем уже учтены
+        if self.claimed_payouts_count is None:
+            # Страницу еще не видели, писать нечего
             return
 
-        await self.tg.notify_admins(f'Пробую авторизовать бота {bot.bot_name}')
-
-        form_data = {
-            'login': bot.turcode_login,
-            'password': bot.turcode_pass,
-            'authenticator': '',
-        }
-        try:
-            request = self.session.post(
-                f'{self.base_url}/authUser.php',
-                data=form_data,
-                headers=self.headers,
+        claimed_total = self.snapshot.claimed_total
+        claimed_payouts_count = self.snapshot.claimed_count
+        async with self.settings.db_session() as session:
+            await Bot.sync_claimed_payouts_count(
+                session, self.db.cur_bot.id, claimed_payouts_count,
+                newly_claimed=claimed_total - self._synced_claimed_total,
+                reservation_ttl=self.settings.claim_reservation_ttl,
             )
-            auth_cookie = await self._extract_auth_cookie(request.headers.get('Set-Cookie'))
-            if auth_cookie is not None:
-                async with self.settings.db_session() as session:
-                    await bot.set_auth_cookie(session, auth_cookie)
-                    await session.commit()
+            await session.commit()
+        self._synced_claimed_total = claimed_total
+
+    def sync_claimed_counts(self):
+        """
+        Сверяет кол-во забранных чужих ботов со снимком конфига. Пока значение
+        в БД не менялось, свои прибавки не трогаем. Когда поменялось, берем его
+        плюс наши claim за последние claimed_count_grace секунд - владелец бота
+        мог еще не увидеть их на своей странице.
+        """
+        now_time = time.time()
+        grace = self.settings.claimed_count_grace
+        for claims in self._own_claims.values():
+            while claims and now_time - claims[0] >= grace:
+                claims.popleft()
+
+        counts = {}
+        for bot in self.db.bots or []:
+            if bot.id == self.db.cur_bot.id:
+                continue
+            if bot.id in self.bots_claimed_counts and self._synced_counts.get(bot.id) == bot.claimed_payouts_count:
+                counts[bot.id] = self.bots_claimed_counts[bot.id]
+                continue
+            counts[bot.id] = bot.claimed_payouts_count + len(self._own_claims.get(bot.id, ()))
+            self._synced_counts[bot.id] = bot.claimed_payouts_count
+        self.bots_claimed_counts = counts
 
-                self.session.cookies.set('auth', auth_cookie)
-        except r.exceptions.RequestException as e:
-            self.logger.error('Request error:', e)
-            return
+    def get_claimed_count(self, bot: BotConfig) -> int:
+        if bot.id == self.db.cur_bot.id:
+            return self.claimed_payouts_count or 0
+        return self.bots_claimed_counts.get(bot.id, bot.claimed_payouts_count)
 
-        self.is_auth = True
+    async def auth(self, bot: BotConfig = None) -> str | None:
+        if bot is None:
+            bot = self.db.cur_bot
+
+        auth_cookie = await self.auth_manager.auth(bot)
+        if auth_cookie is not None and bot.id == self.db.cur_bot.id:
+            self.is_auth = True
         return auth_cookie
 
-    async def get_payouts(self):
+    def _poll_windows(self) -> list[tuple[int, int]]:
+        windows = self.db.amount_windows
+        if self.settings.payouts_window_gap <= 0 or len(windows) < 2:
+            return [(self.db.all_active_bots_min_amount, self.db.all_active_bots_max_amount)]
+        return split_windows(windows, self.settings.payouts_window_gap)
+
+    def _is_sweep_due(self) -> bool:
+        # Если очередь все время длиннее страницы, отсутствие строки никогда ничего не значит
+        # и исчезновения не ловятся - время от времени пролистываем окна целиком
+        sweep_after = self.settings.payouts_sweep_after
+        return sweep_after > 0 and self._truncated_polls >= sweep_after
+
+    def _is_last_page(self, rows_count: int, page: int, is_sweep: bool) -> bool:
+        if not is_sweep or rows_count < self.page_sizer.length:
+            return True
+        return page + 1 >= self.settings.payouts_sweep_max_pages
+
+    def _observe_page(self, rows_counts: list[int], bytes_count: int, is_truncated: bool, is_sweep: bool):
+        self.settings.metrics.observe('poll.bytes', bytes_count)
+        self.settings.metrics.observe('poll.rows', sum(rows_counts))
+        self.page_sizer.update(max(rows_counts, default=0))
+        self.settings.metrics.set('poll.page_length', self.page_sizer.length)
+
+        self._page_truncated = is_truncated
+        if is_truncated:
+            self.settings.metrics.inc('poll.truncated')
+
+        # Даже упершийся в предел страниц полный проход не повторяем на каждом опросе
+        if is_sweep or not is_truncated:
+            self._truncated_polls = 0
+        else:
+            self._truncated_polls += 1
+        if is_sweep:
+            self.settings.metrics.inc('poll.sweeps')
+
+    async def _post_payouts(self, window: tuple[int, int], start: int = 0, stream: bool = False) -> r.Response | None:
         if not self.is_auth:
             await self.auth()
 
         if not self.is_auth:
             self.logger.info(f'{self.is_auth=}')
 
-            async with self.settings.db_session() as session:
-                await self.db.cur_bot.set_is_running(session, False)
-                await session.commit()
-            await self.db.load_bots()
+            self.db.set_bot_values(self.db.cur_bot.id, is_running=False)
 
             await self.tg.notify_admins('Меня выкинуло из системы, нужна авторизация\nВыключаю штуку')
             await self.tg.notify_watchers('Меня выкинуло из системы, нужна авторизация\nВыключаю штуку')
-            return []
+            return None
 
         form_data = {
-            'length': 100,
-            'pfrom': self.db.all_active_bots_min_amount,
-            'pto': self.db.all_active_bots_max_amount,
+            'start': start,
+            'length': self.page_sizer.length,
+            'pfrom': window[0],
+            'pto': window[1],
             'fstatus': 'Pending',
             'ftime': 'All',
         }
@@ -164,68 +295,312 @@ class API:
                 f'{self.base_url}/datatables/payouts.php',
                 data=form_data,
                 headers=self.headers,
+                stream=stream,
             )
 
-            if 'blocked' in request.text:
-                async with self.settings.db_session() as session:
-                    await self.db.cur_bot.set_is_running(session, False)
-                    await session.commit()
-                await self.db.load_bots()
-
-                await self.tg.notify_admins('Меня блокнуло\nВыключаю штуку')
-                await self.tg.notify_watchers('Меня блокнуло\nВыключаю штуку')
-                return []
-
             auth_cookie = await self._extract_auth_cookie(request.headers.get('Set-Cookie'))
             if auth_cookie is not None:
-                self.session.cookies.set('auth', auth_cookie)
+                self.auth_manager.set_cookie(self.db.cur_bot, auth_cookie)
         except r.exceptions.RequestException as e:
             self.logger.error('Request error:', e)
-            return []
+            return None
 
         if request.status_code == 429:
+            request.close()
             await self.tg.notify_admins('Код 429')
             time.sleep(4)
-            return []
+            return None
 
-        try:
-            request_data = request.json()
-            self.auth_error_count = 0
-        except r.exceptions.JSONDecodeError:
-            self.auth_error_count += 1
+        return request
 
-            if self.auth_error_count > 5:
-                self.is_auth = False
+    async def _on_blocked(self):
+        self.db.set_bot_values(self.db.cur_bot.id, is_running=False)
 
-                async with self.settings.db_session() as session:
-                    await self.db.cur_bot.set_auth_cookie(session, auth_cookie)
-                    await session.commit()
-                await self.db.load_bots()
+        await self.tg.notify_admins('Меня блокнуло\nВыключаю штуку')
+        await self.tg.notify_watchers('Меня блокнуло\nВыключаю штуку')
 
-                await self.tg.notify_admins('Выкинуло\nВыключаю штуку')
-                await self.tg.notify_watchers('Выкинуло\nВыключаю штуку')
+    async def _on_bad_response(self):
+        self.auth_error_count += 1
 
-            return []
+        if self.auth_error_count > 5:
+            self.is_auth = False
+
+            self.db.set_bot_values(self.db.cur_bot.id, auth_cookie=self.auth_manager.cookies.get(self.db.cur_bot.id))
+
+            await self.tg.notify_admins('Выкинуло\nВыключаю штуку')
+            await self.tg.notify_watchers('Выкинуло\nВыключаю штуку')
+
+    def _observe_latency(self, name: str):
+        self.settings.metrics.observe(name, (time.perf_counter() - self._poll_started - self._poll_paused) * 1000)
+
+    async def get_payouts(self):
+        self._poll_trace_id = self.settings.tracer.new_trace()
+        with self.settings.tracer.span('get_payouts', self._poll_trace_id):
+            return await self._get_payouts()
+
+    async def _get_payouts(self):
+        self._poll_started = time.perf_counter()
+        self._poll_paused = 0.0
+        rows = []
+        rows_counts = []
+        bytes_count = 0
+        is_sweep = self._is_sweep_due()
+        is_truncated = False
+        for window in self._poll_windows():
+            # Обычный опрос берет одну страницу окна, полный проход листает окно до неполной страницы
+            for page in range(self.settings.payouts_sweep_max_pages):
+                request = await self._post_payouts(window, page * self.page_sizer.length)
+                if request is None:
+                    return None
+
+                if 'blocked' in request.text:
+                    await self._on_blocked()
+                    return None
+
+                try:
+                    request_data = request.json()
+                except r.exceptions.JSONDecodeError:
+                    await self._on_bad_response()
+                    return None
+
+                bytes_count += len(request.content)
+                rows_count = len(request_data['data'])
+                rows_counts.append(rows_count)
+                rows.extend(request_data['data'])
+
+                if self._is_last_page(rows_count, page, is_sweep):
+                    is_truncated |= rows_count >= self.page_sizer.length
+                    break
 
+        self._observe_latency('poll.page_ms')
+        self._observe_page(rows_counts, bytes_count, is_truncated, is_sweep)
         self.is_auth = True
         self.auth_error_count = 0
-        return request_data['data']
+        return rows
+
+    # Разбираем страницу по мере загрузки и отдаем кандидатов сразу, не дожидаясь всего тела
+    async def stream_payouts(self):
+        self._poll_started = time.perf_counter()
+        self._poll_paused = 0.0
+        self._poll_trace_id = self.settings.tracer.new_trace()
+        poll_span = self.settings.tracer.span('get_payouts', self._poll_trace_id, stream=True)
+
+        self._candidates = []
+        self._recheck_rejected()
+        self.snapshot.begin()
+        is_first_candidate = True
+        rows_counts = []
+        bytes_count = 0
+        is_sweep = self._is_sweep_due()
+        is_truncated = False
+        try:
+            for window in self._poll_windows():
+                for page in range(self.settings.payouts_sweep_max_pages):
+                    request = await self._post_payouts(window, page * self.page_sizer.length, stream=True)
+                    if request is None:
+                        return
+
+                    decoder = JSONArrayStream('data')
+                    rows_count = 0
+                    tail = b''
+                    try:
+                        for chunk in request.iter_content(chunk_size=16 * 1024):
+                            if b'blocked' in tail + chunk:
+                                await self._on_blocked()
+                                return
+                            tail = chunk[-8:]
+                            bytes_count += len(chunk)
+
+                            for row in decoder.feed(chunk):
+                                rows_count += 1
+                                self.snapshot.feed(row)
+                                while self._candidates:
+                                    if is_first_candidate:
+                                        self._observe_latency('poll.first_candidate_ms')
+                                        is_first_candidate = False
+                                    # Время claim снаружи в задержку страницы не входит
+                                    paused_at = time.perf_counter()
+                                    yield self._candidates.pop(0)
+                                    self._poll_paused += time.perf_counter() - paused_at
+                    except (r.exceptions.RequestException, ValueError) as e:
+                        self.logger.error('Request error:', e)
+                        return
+                    finally:
+                        request.close()
+
+                    if not decoder.finished:
+                        await self._on_bad_response()
+                        return
+                    rows_counts.append(rows_count)
+
+                    if self._is_last_page(rows_count, page, is_sweep):
+                        is_truncated |= rows_count >= self.page_sizer.length
+                        break
+
+            # Последняя страница дочитана - дальше генератор ничего не ждет
+            self._observe_latency('poll.page_ms')
+        finally:
+            poll_span.end()
+
+        self._observe_page(rows_counts, bytes_count, is_truncated, is_sweep)
+        self.is_auth = True
+        self.auth_error_count = 0
+
+        self.snapshot.finish(not self._page_truncated)
+        self._prune_first_seen()
+        self.claimed_payouts_count = self.snapshot.claimed_count
+
+    # Распределяем пачку платежей по ботам с учетом оставшихся слотов
+    async def plan_claims(self, payouts: list) -> list[tuple[dict, BotConfig]]:
+        items = []
+        for payout in payouts:
+            # Платежи по номеру телефона (СБП) берем из любого банка
+            bank = payout.get('bank', '')
+            if len(payout.get('card', '')) == 11 or len(payout.get('phone', '')) == 11:
+                bank = None
+
+            amount = self.str_to_int(payout.get('amount', 0))
+            bots = await self.db.get_bots_by_amount(amount, bank)
+            if not bots:
+                # Ни одному боту не подходит сумма или банк - до смены конфига платеж не смотрим
+                self._rejected_ids.add(payout['id'])
+                continue
+
+            items.append((payout, amount, bots))
+
+        capacities = {
+            bot.id: bot.claimed_payouts_limit - self.get_claimed_count(bot)
+            for bot in self.db.bots or []
+            if bot.is_running
+        }
+        plan = self.planner.plan(items, capacities)
+
+        # Не влезшие в лимиты платежи посмотрим еще раз на следующем опросе
+        planned_ids = {payout['id'] for payout, _ in plan}
+        for payout, _, _ in items:
+            if payout['id'] not in planned_ids:
+                self.snapshot.discard(payout['id'])
+
+        return plan
+
+    async def _reserve_claim_slots(self, requested: dict[int, int]) -> dict[int, int]:
+        async with self.settings.db_session() as session:
+            granted = await Bot.reserve_claim_slots(session, requested)
+            await session.commit()
+        return granted
+
+    # Занимаем в БД слоты под запланированные claim, не получившие слот платежи посмотрим на следующем опросе
+    async def reserve_claims(self, plan: list[tuple[dict, BotConfig]]) -> tuple[list[tuple[dict, BotConfig]], bool]:
+        """Возвращает платежи, которые можно забирать, и признак того, что слоты под них заняты в БД"""
+        requested = Counter(bot.id for _, bot in plan)
+        if not requested:
+            return [], False
+
+        # Подвисшая или лежащая БД не должна держать забор: план уже уложен в лимиты
+        # по памяти, с ним и идем, а брони попробуем снова через reserve_retry_interval
+        if time.monotonic() < self._reserve_paused_until:
+            self.settings.metrics.inc('quota.reserve_skipped', len(plan))
+            return plan, False
+        reserve_task = asyncio.ensure_future(self._reserve_claim_slots(dict(requested)))
+        try:
+            # Транзакцию не отменяем: по таймауту коммит мог уже пройти, тогда брони вернем по его завершении
+            granted = await asyncio.wait_for(asyncio.shield(reserve_task), self.settings.claim_reserve_timeout)
+        except (asyncio.TimeoutError, SQLAlchemyError, OSError) as e:
+            self.logger.error(f'Claim reserve error: {e!r}')
+            self.settings.metrics.inc('quota.reserve_errors')
+            self._reserve_paused_until = time.monotonic() + self.settings.claim_reserve_retry_interval
+            if not reserve_task.done():
+                self._late_reservations.add(reserve_task)
+                reserve_task.add_done_callback(self._release_late_reservation)
+            return plan, False
+
+        granted_count = sum(granted.values())
+        self.settings.metrics.inc('quota.reserved', granted_count)
+        if granted_count < len(plan):
+            self.settings.metrics.inc('quota.contention', len(plan) - granted_count)
+
+        reserved = []
+        for payout, bot in plan:
+            if granted.get(bot.id, 0) > 0:
+                granted[bot.id] -= 1
+                reserved.append((payout, bot))
+            else:
+                self.snapshot.discard(payout['id'])
+        return reserved, True
+
+    def _release_late_reservation(self, task: asyncio.Task):
+        self._late_reservations.discard(task)
+        if task.cancelled() or task.exception() is not None:
+            return
+
+        # План уже ушел без броней, так что все выданное - лишнее
+        granted = {bot_id: count for bot_id, count in task.result().items() if count > 0}
+        if granted:
+            self.settings.metrics.inc('quota.late_reserved', sum(granted.values()))
+            self._release_slots(granted)
+
+    def release_claim(self, bot: BotConfig):
+        """Возвращает слот бота в фоне, claim не ждет БД"""
+        self._release_slots({bot.id: 1})
+
+    def _release_slots(self, counts: dict[int, int]):
+        self._pending_releases.update(counts)
+        if self._release_task is None or self._release_task.done():
+            self._release_task = asyncio.create_task(self._flush_releases())
+
+    async def _flush_releases(self):
+        while self._pending_releases:
+            releases, self._pending_releases = self._pending_releases, Counter()
+            try:
+                async with self.settings.db_session() as session:
+                    for bot_id, count in releases.items():
+                        await Bot.release_claim_slots(session, bot_id, count)
+                    await session.commit()
+            except Exception as e:
+                self.logger.error(f'Claim release error: {e!r}')
+                self.settings.metrics.inc('quota.release_errors')
+                # Не вернули - попробуем еще раз, потерянные брони все равно снимет claim_reservation_ttl
+                self._pending_releases.update(releases)
+                await asyncio.sleep(self.settings.claim_reserve_retry_interval)
+                continue
+
+            self.settings.metrics.inc('quota.released', sum(releases.values()))
 
     # Забираем платеж
-    async def claim_payout(self, payout) -> bool:
+    async def claim_payout(self, payout, bot_to_claim: BotConfig = None, is_reserved: bool = False) -> bool:
+        trace_id = payout.get('trace_id')
+        is_claimed = False
+        try:
+            with self.settings.tracer.span('claim_payout', trace_id, payout_id=payout['id']) as span:
+                is_claimed = await self._claim_payout(payout, bot_to_claim, span)
+                if span is not None:
+                    span.set('claimed', is_claimed)
+        finally:
+            # Слот был занят заранее, неудачный или оборвавшийся claim его возвращает
+            if is_reserved and not is_claimed:
+                self.release_claim(bot_to_claim)
+        return is_claimed
+
+    async def _claim_payout(self, payout, bot_to_claim: BotConfig = None, span=None) -> bool:
+        trace_id = payout.get('trace_id')
+        tracer = self.settings.tracer
+
         # if not self.is_auth:
         #     self.auth()
 
-        bot_to_claim = await self.db.get_bot_by_amount(self.str_to_int(payout.get('amount', 0)))
         if bot_to_claim is None:
+            plan = await self.plan_claims([payout])
+            if not plan:
+                return False
+            bot_to_claim = plan[0][1]
+
+        # Без куки не ждем логина: авторизация уже запущена в фоне, платеж посмотрим на следующем опросе
+        if self.auth_manager.get_cookie(bot_to_claim) is None:
+            self.snapshot.discard(payout['id'])
             return False
 
-        if bot_to_claim.claimed_payouts_count >= bot_to_claim.claimed_payouts_limit:
-            return False
-
-        auth_cookie = bot_to_claim.auth_cookie
-        if not auth_cookie:
-            auth_cookie = await self.auth(bot_to_claim)
+        if span is not None:
+            span.set('bot', bot_to_claim.bot_name)
 
         # # Чекаем забирался ли платеж другим ботом
         # with Session(self.settings.engine) as session, session.begin():
@@ -242,18 +617,16 @@ class API:
             'mode': 'claim',
         }
 
-        if bot_to_claim.id != self.db.cur_bot.id:
-            session = r.Session()
-            session.cookies.set('auth', auth_cookie)
-        else:
-            session = self.session
+        session = self.auth_manager.get_session(bot_to_claim)
 
+        claim_sent_at = time.time()
         try:
-            request = session.post(
-                f'{self.base_url}/prtProcessPayoutsOwnership.php',
-                data=form_data,
-                headers=self.headers,
-            )
+            with tracer.span('claim_request', trace_id, span):
+                request = session.post(
+                    f'{self.base_url}/prtProcessPayoutsOwnership.php',
+                    data=form_data,
+                    headers=self.headers,
+                )
             # self.settings.notifications.admins.append(
             #     f'Ответ системы ({time.time()})\n\n'
             #     f'status - {request.status_code}\n'
@@ -261,78 +634,72 @@ class API:
             # )
         except r.exceptions.RequestException as e:
             self.logger.error('Request error:', e)
-
-            async with self.settings.db_session() as session:
-                await bot_to_claim.set_auth_cookie(session, None)
-                await session.commit()
-            await self.db.load_bots()
+            self.snapshot.discard(payout['id'])
+            self.auth_manager.invalidate(bot_to_claim)
 
             return False
 
+        claim_answered_at = time.time()
         self.logger.info(request.status_code, request.text)
 
         try:
             request_data = request.json()
         except r.exceptions.JSONDecodeError as e:
             self.logger.error(f'Request error  {request.status_code} {request.text}:', e)
+            self.snapshot.discard(payout['id'])
+            self.auth_manager.invalidate(bot_to_claim)
 
-            async with self.settings.db_session() as session:
-                await bot_to_claim.set_auth_cookie(session, None)
-                await session.commit()
-            await self.db.load_bots()
+            return False
+
+        # Здесь только дозапись в журнал, спан payout_write откроется при вставке в БД
+        with tracer.span('journal_append', trace_id, span, status=request_data['status']):
+            self._write_payout(payout, bot_to_claim, request_data, claim_sent_at, claim_answered_at)
 
+        if not request_data['status']:
+            # Как и раньше, пока платеж висит на странице, пробуем забрать его на каждом опросе
+            self.snapshot.discard(payout['id'])
             return False
 
+        if trace_id is not None:
+            self._operation_traces[payout.get('operation_id', '')] = trace_id
+        if bot_to_claim.id == self.db.cur_bot.id:
+            self.claimed_payouts_count = (self.claimed_payouts_count or 0) + 1
+        else:
+            self.bots_claimed_counts[bot_to_claim.id] = self.get_claimed_count(bot_to_claim) + 1
+            self._own_claims.setdefault(bot_to_claim.id, deque()).append(time.time())
+        return True
+
+    def _write_payout(self, payout: dict, bot_to_claim: BotConfig, request_data: dict,
+                      claim_sent_at: float, claim_answered_at: float):
         def erow(row: str):
             if row is None:
                 return None
             return row.encode('latin-1', 'ignore').decode('utf-8', 'ignore')
 
-        async with self.settings.db_session() as session:
-            payout_row = Payout(
-                operation_id=payout.get('operation_id', ''),
-                user_id=payout.get('user_id', ''),
-                amount=self.str_to_int(payout.get('amount', 0)),
-                bot_name=bot_to_claim.bot_name,
-                # bank_name=erow(payout.get('bank', None)),
-                card=erow(payout.get('card', None)),
-                phone=erow(payout.get('phone', None)),
-                payout_id=erow(payout.get('id', None)),
-            )
-            if request_data['status']:
-                # success_msg = (
-                #     f'Платеж забран\n'
-                #     f'Сумма - 💰{payout['amount']}💰\n'
-                #     f'Карта - 💸{payout['card']}💸'
-                # )
-
-                # Чекаем забирал ли текущий бот этот платеж
-                # cur_bot_operation_payouts_count = Payout.get_count_by_operation_id_and_bot_name(
-                #     session=session,
-                #     bot_name=self.settings.bot_name,
-                #     operation_id=payout['operation_id'],
-                # )
-                # if cur_bot_operation_payouts_count > 0:
-                #     success_msg += '\n\n‼️Кажется, этот платеж уже забирался‼️'
-                #
-                # self.settings.notifications.admins.append(success_msg)
-                # self.settings.notifications.watchers.append(success_msg)
-
-                payout_row.action = PayoutActionEnum.SUCCESS.code
-                session.add(payout_row)
-                await session.commit()
-
-                if bot_to_claim.id == self.db.cur_bot.id:
-                    self.claimed_payouts_count += 1
-                return True
-            else:
-                payout_row.action = PayoutActionEnum.FAIL.code
-                session.add(payout_row)
-                await session.commit()
-
-        return False
+        # В payouts строка уйдет из журнала в фоне, claim не ждет БД
+        self.journal.append({
+            'action': (PayoutActionEnum.SUCCESS.code if request_data['status'] else PayoutActionEnum.FAIL.code),
+            'operation_id': payout.get('operation_id', ''),
+            'user_id': payout.get('user_id', ''),
+            'amount': self.str_to_int(payout.get('amount', 0)),
+            'bot_name': bot_to_claim.bot_name,
+            'card': erow(payout.get('card', None)),
+            'phone': erow(payout.get('phone', None)),
+            'payout_id': erow(payout.get('id', None)),
+            'upstream_time': erow(payout.get('time', None)),
+            'seen_at': payout.get('seen_at'),
+            'attempt_seen_at': payout.get('attempt_seen_at'),
+            'claim_sent_at': claim_sent_at,
+            'claim_answered_at': claim_answered_at,
+            'created_at': claim_answered_at,
+            'trace_id': payout.get('trace_id'),
+        })
+
+    def get_webstats(self, session: r.Session, timeout: float | None = None) -> list:
+        auth_cookie = self.auth_manager.cookies.get(self.db.cur_bot.id)
+        if auth_cookie:
+            session.cookies.set('auth', auth_cookie)
 
-    def get_webstats(self) -> list:
         try:
             form_data = {
                 'draw': 100,
@@ -340,9 +707,10 @@ class API:
                 'length': 100,
             }
 
-            request = self.session.post(
+            request = session.post(
                 f'{self.base_url}/datatables/tstats.php',
                 data=form_data,
+                timeout=timeout,
             )
         except r.exceptions.RequestException as e:
             return []
@@ -362,114 +730,110 @@ class API:
             })
         return result
 
-    # Получаем обработанные платежи
-    async def load_payouts(self):
-        payouts_count_limit = self.db.cur_bot.claimed_payouts_limit
-        if self.claimed_payouts_count is None or self.claimed_payouts_count >= payouts_count_limit:
-            self.claimed_payouts_count = 0
-            # await self.tg.notify_admins('Обновляю claimed_payouts_count')
-            all_payouts = await self.get_payouts()
-            for row in all_payouts:
-                if row[3]:
-                    self.claimed_payouts.add(row[16])
-                    self.claimed_payouts_count += 1
-
-            time.sleep(2)
-
-        if self.claimed_payouts_count >= payouts_count_limit:
-            return []
+    def _on_new_payout(self, event: PayoutEvent):
+        # Платеж мог вернуться в общий пул после того, как был забран
+        self.reminders.cancel(event.payout_id)
+
+        row = event.row
+
+        card = row[9]
+        card_match = re.search(r'\d+', card)
+        if card_match:
+            card = card_match.group(0)
+
+        attempt_seen_at = time.time()
+        seen_at = self._first_seen.setdefault(event.payout_id, attempt_seen_at)
+
+        trace_id = self.settings.tracer.new_trace()
+        self.settings.tracer.span(
+            'load_payouts', trace_id,
+            payout_id=event.payout_id,
+            poll_trace_id=self._poll_trace_id,
+            poll_ms=int((time.perf_counter() - self._poll_started) * 1000),
+        ).end()
+
+        payout = {
+            'time': row[0],
+            'status': row[1],
+            'id': event.payout_id,
+            'amount': row[6],
+            'bank': row[8],
+            'card': card,
+            'phone': row[15],
+            'operation_id': row[16],
+            'user_id': row[17],
+            'seen_at': seen_at,
+            'attempt_seen_at': attempt_seen_at,
+            'trace_id': trace_id,
+        }
 
-        _time_ending_notified_payouts = []
-        payouts = []
-        self.claimed_payouts_count = 0
-        for row in await self.get_payouts():
-            claim_btn = row[2]
-            payout_id = claim_btn.split('data-id=')[1].split("'")[1]
-
-            is_able = not row[3]
-            if not is_able:
-                self.claimed_payouts.add(row[16])
-                self.claimed_payouts_count += 1
-                end_time = row[4].split('data-end-time=')[1].split("'")[1]
-                try:
-                    end_time = int(end_time) // 1000
-                    end_time -= 6 * 60 * 60
-                except ValueError:
-                    continue
-
-                now_time = datetime.datetime.utcnow().timestamp()
-                time_diff = end_time - now_time
-
-                for _msg_text, check_fun in [
-                    ['Осталось 15 минут', lambda _time_diff: 14 * 60 < time_diff < 15 * 60],
-                    ['Осталось 5 минут', lambda _time_diff: 4 * 60 < time_diff < 5 * 60],
-                ]:
-                    if check_fun(time_diff):
-                        _time_ending_notified_payouts.append(payout_id)
-                        if payout_id not in self.time_ending_notified_payouts:
-                            remind_msg_text = (f'❗️У платежа заканчивается время для оплаты\n'
-                                               f'{_msg_text}\n'
-                                               f'Operation ID: {row[16]} Сумма: {row[6]}')
-                            self.settings.notifications.add_to_all(remind_msg_text)
+        # self.logger.info(f'Payout found: {payout}')
+        # self.settings.notifications.admins.append(f'Найден платеж ({time.time()})\n\n{self.dict_to_str(payout)}')
+        self._candidates.append(payout)
 
-                continue
-            card = row[9]
-            card_match = re.search(r'\d+', card)
-            if card_match:
-                card = card_match.group(0)
-
-            payout = {
-                'time': row[0],
-                'status': row[1],
-                'id': payout_id,
-                'amount': row[6],
-                'bank': row[8],
-                'card': card,
-                'phone': row[15],
-                'operation_id': row[16],
-                'user_id': row[17],
-            }
+    def _on_claimed_payout(self, event: PayoutEvent):
+        self._first_seen.pop(event.payout_id, None)
+        with self._claimed_lock:
+            self.claimed_payouts.setdefault(event.row[16], time.time())
 
-            bank_is_correct = False
-            lower_payout_bank = payout['bank'].lower()
-            for bank_name in [
-                'Тинькофф',
-                'Tinkoff',
-                'T-Bank',
-                'Сбербанк',
-                'Sberbank',
-                # 'Райффайзен',
-                # 'Raiffeisen',
-            ]:
-                if bank_name.lower() in lower_payout_bank:
-                    bank_is_correct = True
-                    break
+        end_time = extract_end_time(event.row)
+        if end_time is not None:
+            self.reminders.register(event.payout_id, end_time - self.settings.end_time_offset, event.row)
 
-            if not bank_is_correct and not (len(payout['card']) == 11 or len(payout['phone']) == 11):
-                continue
+    def _prune_first_seen(self):
+        # Платеж, забытый через discard, при уходе со страницы не дает события DISAPPEARED
+        if self._page_truncated:
+            return
+        seen = self.snapshot.seen
+        for payout_id in self._first_seen.keys() - seen:
+            del self._first_seen[payout_id]
+
+    def _recheck_rejected(self):
+        # Конфиг поменялся (суммы, банки, запуск ботов) - отклоненные платежи вернутся в опрос как новые
+        config = self.db.config
+        if config is self._rejected_config:
+            return
+        self._rejected_config = config
+        for payout_id in self._rejected_ids:
+            self.snapshot.discard(payout_id)
+        self._rejected_ids.clear()
+
+    def _on_disappeared_payout(self, event: PayoutEvent):
+        self._rejected_ids.discard(event.payout_id)
+        self._first_seen.pop(event.payout_id, None)
+        self.reminders.cancel(event.payout_id)
+
+    def _on_reminder(self, payout_id: str, msg_text: str, row: list):
+        self.events.emit(PayoutEvent(PayoutEventType.EXPIRING, payout_id, row, msg_text))
+
+    async def run_reminders(self):
+        await self.reminders.run(self._on_reminder)
+
+    def _on_expiring_payout(self, event: PayoutEvent):
+        remind_msg_text = (f'❗️У платежа заканчивается время для оплаты\n'
+                           f'{event.message}\n'
+                           f'Operation ID: {event.row[16]} Сумма: {event.row[6]}')
+        self.settings.notifications.add_to_all(remind_msg_text)
+
+    # Получаем обработанные платежи
+    async def load_payouts(self):
+        rows = await self.get_payouts()
+        if rows is None:
+            return []
 
-            # self.logger.info(f'Payout found: {payout}')
-            # self.settings.notifications.admins.append(f'Найден платеж ({time.time()})\n\n{self.dict_to_str(payout)}')
-            payouts.append(payout)
-
-        self.time_ending_notified_payouts = _time_ending_notified_payouts
-        return payouts
-
-    # async def get_stats(self) -> list:
-    #     webapp_list = os.getenv('WEBAPP_LIST', default=None)
-    #     if webapp_list is None:
-    #         return []
-    #
-    #     webapp_list = list(map(lambda l: l.split('::'), webapp_list.split(';')))
-    #
-    #     result = []
-    #     for ip, password in webapp_list:
-    #         try:
-    #             host_data = r.get(f'{ip}/webstats', headers={'Authorization': f'Bearer {password}'}).json()
-    #         except r.exceptions.RequestException as e:
-    #             self.logger.error(f'Ping {ip} error method webstats: {e}')
-    #             host_data = None
-    #
-    #         result.append(host_data)
-    #
-    #     return result
+        # Через фильтры и маршрутизацию проходят только новые строки страницы
+        self._candidates = []
+        self._recheck_rejected()
+        self.snapshot.begin()
+        for row in rows:
+            self.snapshot.feed(row)
+        self.snapshot.finish(not self._page_truncated)
+        self._prune_first_seen()
+
+        if self._candidates:
+            self._observe_latency('poll.first_candidate_ms')
+
+        # Кол-во забранных и кандидаты берутся из одной и той же страницы,
+        # лимиты проверяются по каждому боту при маршрутизации
+        self.claimed_payouts_count = self.snapshot.claimed_count
+        return self._candidates
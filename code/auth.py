@@ -0,0 +1,128 @@
+import asyncio
+import os
+import time
+from typing import TYPE_CHECKING
+
+import requests as r
+
+from code.config import BotConfig
+from code.models import Bot
+
+if TYPE_CHECKING:
+    from code.api import API
+
+
+class AuthManager:
+    """
+    Куки ботов и авторизация в turcode.
+
+    Одновременные попытки авторизовать одного и того же бота склеиваются в одну,
+    куки обновляются в фоне до истечения срока и после мягких ошибок, так что
+    забор платежа никогда не ждет логина.
+    """
+    api: 'API'
+    cookies: dict[int, str]
+    cookie_times: dict[int, float]
+    sessions: dict[int, r.Session]
+
+    def __init__(self, api: 'API'):
+        self.api = api
+        self.cookies = {}
+        self.cookie_times = {}
+        self.sessions = {}
+        self._inflight: dict[int, asyncio.Task] = {}
+        # Последние увиденные в БД куки, чтобы подхватывать авторизацию из других процессов
+        self._db_cookies: dict[int, str] = {}
+
+        self.cookie_ttl = int(os.getenv('AUTH_COOKIE_TTL', 6 * 60 * 60))
+        self.check_interval = int(os.getenv('AUTH_CHECK_INTERVAL', 60))
+
+    def get_session(self, bot: BotConfig) -> r.Session:
+        session = self.sessions.get(bot.id)
+        if session is None:
+            session = self.sessions[bot.id] = r.Session()
+            cookie = self.cookies.get(bot.id)
+            if cookie:
+                session.cookies.set('auth', cookie)
+        return session
+
+    def set_cookie(self, bot: BotConfig, auth_cookie: str):
+        self.cookies[bot.id] = auth_cookie
+        self.cookie_times[bot.id] = time.time()
+        self.get_session(bot).cookies.set('auth', auth_cookie)
+
+    def get_cookie(self, bot: BotConfig) -> str | None:
+        """Текущая кука бота без ожидания, при ее отсутствии запускает авторизацию в фоне"""
+        if bot.auth_cookie and bot.auth_cookie != self._db_cookies.get(bot.id):
+            self._db_cookies[bot.id] = bot.auth_cookie
+            self.set_cookie(bot, bot.auth_cookie)
+
+        auth_cookie = self.cookies.get(bot.id)
+        if auth_cookie is None:
+            self.refresh(bot)
+        return auth_cookie
+
+    def invalidate(self, bot: BotConfig):
+        """Мягкая ошибка: старая кука остается, пока в фоне не получим новую"""
+        self.refresh(bot)
+
+    def refresh(self, bot: BotConfig) -> asyncio.Task:
+        task = self._inflight.get(bot.id)
+        if task is None or task.done():
+            task = self._inflight[bot.id] = asyncio.create_task(self._auth(bot))
+        return task
+
+    async def auth(self, bot: BotConfig) -> str | None:
+        return await asyncio.shield(self.refresh(bot))
+
+    async def _auth(self, bot: BotConfig) -> str | None:
+        # Предотвращаем бесконечную авторизацию
+        if bot.turcode_login is None or bot.turcode_pass is None:
+            return None
+
+        self.api.logger.info(f'Пробую авторизовать бота {bot.bot_name}')
+
+        form_data = {
+            'login': bot.turcode_login,
+            'password': bot.turcode_pass,
+            'authenticator': '',
+        }
+        try:
+            request = await asyncio.to_thread(
+                r.post,
+                f'{self.api.base_url}/authUser.php',
+                data=form_data,
+                headers=self.api.headers,
+            )
+        except r.exceptions.RequestException as e:
+            self.api.logger.error('Request error:', e)
+            await self.api.tg.notify_admins(f'Не удалось авторизовать бота {bot.bot_name}')
+            return None
+
+        auth_cookie = await self.api._extract_auth_cookie(request.headers.get('Set-Cookie'))
+        if auth_cookie is None:
+            return None
+
+        self.set_cookie(bot, auth_cookie)
+        self._db_cookies[bot.id] = auth_cookie
+        async with self.api.settings.db_session() as session:
+            await Bot.set_auth_cookie(session, bot.id, auth_cookie)
+            await session.commit()
+
+        return auth_cookie
+
+    async def run(self):
+        """Заранее обновляет куки запущенных ботов, пока они не протухли"""
+        while True:
+            now_time = time.time()
+            for bot in self.api.db.bots or []:
+                if not bot.is_running or bot.turcode_login is None:
+                    continue
+
+                cookie_time = self.cookie_times.get(bot.id)
+                if cookie_time is None:
+                    self.get_cookie(bot)
+                elif now_time - cookie_time > self.cookie_ttl * 0.8:
+                    self.refresh(bot)
+
+            await asyncio.sleep(self.check_interval)
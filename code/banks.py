@@ -0,0 +1,34 @@
+import functools
+import re
+
+DEFAULT_BANKS = (
+    'Тинькофф',
+    'Tinkoff',
+    'T-Bank',
+    'Сбербанк',
+    'Sberbank',
+    # 'Райффайзен',
+    # 'Raiffeisen',
+)
+
+
+def parse_banks(value: str | None) -> tuple[str, ...]:
+    if value is None:
+        return DEFAULT_BANKS
+    return tuple(bank.strip() for bank in value.split(',') if bank.strip())
+
+
+@functools.lru_cache(maxsize=64)
+def get_bank_matcher(value: str | None) -> re.Pattern | None:
+    """Собирает список банков в одну регулярку, пересобирается только при изменении списка"""
+    banks = parse_banks(value)
+    if not banks:
+        return None
+
+    banks = sorted(set(banks), key=len, reverse=True)
+    return re.compile('|'.join(re.escape(bank) for bank in banks), re.IGNORECASE)
+
+
+def is_bank_allowed(value: str | None, bank: str) -> bool:
+    matcher = get_bank_matcher(value)
+    return matcher is not None and matcher.search(bank) is not None
@@ -0,0 +1,123 @@
+import bisect
+import dataclasses
+from types import MappingProxyType
+from typing import Mapping
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class UserConfig:
+    id: int
+    name: str
+    chat_id: str
+    is_admin: bool
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class BotConfig:
+    id: int
+    bot_name: str
+    is_running: bool
+    is_active: bool
+    min_amount: int
+    max_amount: int
+    tg_bot_token: str | None
+    turcode_login: str | None
+    turcode_pass: str | None
+    auth_cookie: str | None
+    claimed_payouts_limit: int
+    claimed_payouts_count: int
+    allowed_banks: str | None
+    users: tuple[UserConfig, ...] = ()
+    user_chat_ids: frozenset[str] = frozenset()
+    admin_chat_ids: frozenset[str] = frozenset()
+
+
+BOT_FIELDS = tuple(field.name for field in dataclasses.fields(BotConfig) if field.name not in (
+    'users', 'user_chat_ids', 'admin_chat_ids'))
+USER_FIELDS = tuple(field.name for field in dataclasses.fields(UserConfig))
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class ConfigSnapshot:
+    """
+    Неизменяемый снимок ботов и пользователей, оторванный от ORM.
+
+    Собирается целиком при перезагрузке и подменяется в DB одним присваиванием,
+    поэтому читать его из разных задач безопасно.
+    """
+    bots: tuple[BotConfig, ...] = ()
+    bots_by_id: Mapping[int, BotConfig] = MappingProxyType({})
+    bots_by_name: Mapping[str, BotConfig] = MappingProxyType({})
+    users: tuple[UserConfig, ...] = ()
+    users_by_chat_id: Mapping[str, UserConfig] = MappingProxyType({})
+
+    # Запущенные боты, отсортированные по min_amount
+    running_bots: tuple[BotConfig, ...] = ()
+    running_min_amounts: tuple[int, ...] = ()
+    # Непересекающиеся отрезки сумм, покрытые запущенными ботами
+    amount_windows: tuple[tuple[int, int], ...] = ()
+    is_any_bot_active: bool = False
+    min_amount: int | None = None
+    max_amount: int | None = None
+
+    # Сырые строки из БД, по ним определяем, что ничего не поменялось
+    bot_rows: tuple = ()
+    user_rows: tuple = ()
+    links: tuple = ()
+
+    @classmethod
+    def build(cls, bot_rows: tuple, user_rows: tuple, links: tuple) -> 'ConfigSnapshot':
+        users = tuple(UserConfig(*row) for row in user_rows)
+        users_by_id = {user.id: user for user in users}
+
+        bot_users: dict[int, list[UserConfig]] = {}
+        for user_id, bot_id in links:
+            user = users_by_id.get(user_id)
+            if user is not None:
+                bot_users.setdefault(bot_id, []).append(user)
+
+        bots = []
+        for row in bot_rows:
+            bot = BotConfig(*row)
+            users_of_bot = tuple(bot_users.get(bot.id, ()))
+            bots.append(dataclasses.replace(
+                bot,
+                users=users_of_bot,
+                user_chat_ids=frozenset(user.chat_id for user in users_of_bot),
+                admin_chat_ids=frozenset(user.chat_id for user in users_of_bot if user.is_admin),
+            ))
+
+        return cls.from_bots(tuple(bots), users, bot_rows, user_rows, links)
+
+    @classmethod
+    def from_bots(cls, bots: tuple[BotConfig, ...], users: tuple[UserConfig, ...],
+                  bot_rows: tuple = (), user_rows: tuple = (), links: tuple = ()) -> 'ConfigSnapshot':
+        running_bots = tuple(sorted((bot for bot in bots if bot.is_running), key=lambda bot: bot.min_amount))
+
+        amount_windows = []
+        for bot in running_bots:
+            if amount_windows and bot.min_amount <= amount_windows[-1][1]:
+                amount_windows[-1] = (amount_windows[-1][0], max(amount_windows[-1][1], bot.max_amount))
+            else:
+                amount_windows.append((bot.min_amount, bot.max_amount))
+
+        return cls(
+            bots=bots,
+            bots_by_id=MappingProxyType({bot.id: bot for bot in bots}),
+            bots_by_name=MappingProxyType({bot.bot_name: bot for bot in bots}),
+            users=users,
+            users_by_chat_id=MappingProxyType({user.chat_id: user for user in users}),
+            running_bots=running_bots,
+            running_min_amounts=tuple(bot.min_amount for bot in running_bots),
+            amount_windows=tuple(amount_windows),
+            is_any_bot_active=bool(running_bots),
+            min_amount=min((bot.min_amount for bot in running_bots), default=None),
+            max_amount=max((bot.max_amount for bot in running_bots), default=None),
+            bot_rows=bot_rows,
+            user_rows=user_rows,
+            links=links,
+        )
+
+    def get_running_bots_by_amount(self, amount: int) -> list[BotConfig]:
+        end = bisect.bisect_right(self.running_min_amounts, amount)
+        return [bot for bot in self.running_bots[:end] if amount <= bot.max_amount]
@@ -1,62 +1,225 @@
+import asyncio
+import dataclasses
+import json
+import os
 from typing import Sequence
 
-from code.models import Bot, User
+import asyncpg
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+
+from code.banks import is_bank_allowed
+from code.config import BOT_FIELDS, USER_FIELDS, BotConfig, ConfigSnapshot, UserConfig
+from code.models import Bot, User, user_bot_association
 from code.settings import Settings
 
 
-class DB:
-    settings: Settings
+CONFIG_CHANNEL = 'config_changes'
+
 
-    cur_bot: Bot | None = None
-    bots: Sequence[Bot] | None = None
+def _patch_rows(rows: tuple, key, new_rows: tuple, key_index: int = 0) -> tuple:
+    """Заменяет в сырых строках снимка строки с заданным ключом"""
+    return tuple(sorted(
+        [row for row in rows if row[key_index] != key] + list(new_rows),
+        key=lambda row: (row[key_index], row),
+    ))
 
-    is_any_bot_active: bool = False
-    all_active_bots_min_amount: int | None = None
-    all_active_bots_max_amount: int | None = None
 
-    users: Sequence[User] | None = None
+class DB:
+    settings: Settings
+    config: ConfigSnapshot
+    is_listening: bool = False
 
     def __init__(self, settings: Settings) -> None:
         self.settings = settings
+        self.config = ConfigSnapshot()
+        self._pending_writes: set[asyncio.Task] = set()
+        self.write_retries = int(os.getenv('BOT_WRITE_RETRIES', 3))
+
+    @property
+    def cur_bot(self) -> BotConfig | None:
+        return self.config.bots_by_name.get(self.settings.bot_name)
+
+    @property
+    def bots(self) -> Sequence[BotConfig]:
+        return self.config.bots
+
+    @property
+    def users(self) -> Sequence[UserConfig]:
+        return self.config.users
+
+    @property
+    def is_any_bot_active(self) -> bool:
+        return self.config.is_any_bot_active
+
+    @property
+    def all_active_bots_min_amount(self) -> int | None:
+        return self.config.min_amount
+
+    @property
+    def all_active_bots_max_amount(self) -> int | None:
+        return self.config.max_amount
+
+    @property
+    def amount_windows(self) -> tuple[tuple[int, int], ...]:
+        return self.config.amount_windows
+
+    def _swap(self, bot_rows: tuple, user_rows: tuple, links: tuple):
+        config = self.config
+        # Ничего не поменялось - снимок не пересобираем
+        if (bot_rows, user_rows, links) == (config.bot_rows, config.user_rows, config.links):
+            return
+        self.config = ConfigSnapshot.build(bot_rows, user_rows, links)
+
+    def set_bot_values(self, bot_id: int, **values):
+        """Меняет бота в памяти сразу, а запись в БД отправляет в фон"""
+        config = self.config
+        if bot_id not in config.bots_by_id:
+            return
+
+        bots = tuple(dataclasses.replace(bot, **values) if bot.id == bot_id else bot for bot in config.bots)
+        # Сырые строки оставляем старыми: как только запись дойдет до БД,
+        # load_bots увидит разницу и пересоберет снимок уже из БД
+        self.config = ConfigSnapshot.from_bots(bots, config.users, config.bot_rows, config.user_rows, config.links)
+
+        task = asyncio.create_task(self._write_bot_values(bot_id, values))
+        self._pending_writes.add(task)
+        task.add_done_callback(self._pending_writes.discard)
+
+    async def _write_bot_values(self, bot_id: int, values: dict):
+        for attempt in range(1, self.write_retries + 1):
+            try:
+                async with self.settings.db_session() as session:
+                    await Bot.set_values(session, bot_id, **values)
+                    await session.commit()
+                return
+            except Exception as e:
+                self.settings.logger.error(f'Bot {bot_id} write error {values} (attempt {attempt}): {e}')
+                if attempt < self.write_retries:
+                    await asyncio.sleep(attempt)
+
+        # Следующий load_bots вернет старые значения из БД, молча это терять нельзя
+        self.settings.metrics.inc('db.bot_write_errors')
+        changes = ', '.join(f'{name}={value}' for name, value in values.items() if name != 'auth_cookie')
+        self.settings.notifications.add_to_admins(
+            f'❗️Не удалось сохранить изменения бота в БД: {changes or "auth_cookie"}\n'
+            f'После перезагрузки настроек они откатятся, повторите команду'
+        )
+
+    async def flush_writes(self):
+        # Записи из потока горячего пути живут в его loop, их отсюда не дождаться
+        loop = asyncio.get_running_loop()
+        pending = [task for task in tuple(self._pending_writes) if task.get_loop() is loop]
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
 
-    async def _find_cur_bot(self) -> Bot | None:
-        if not self.bots:
-            return None
+    async def load_bots(self):
+        # Иначе можно перечитать из БД значения, которые мы только что поменяли в памяти
+        await self.flush_writes()
 
-        for bot in self.bots:
-            if bot.bot_name == self.settings.bot_name:
-                return bot
+        async with self.settings.db_session() as session:
+            bot_rows = await session.execute(
+                select(*(getattr(Bot, name) for name in BOT_FIELDS)).where(Bot.is_active).order_by(Bot.id)
+            )
+            links = await session.execute(self._select_links())
+            user_rows = self.config.user_rows
+            if not user_rows:
+                user_rows = await self._select_users(session)
 
-        return None
+        self._swap(tuple(map(tuple, bot_rows)), user_rows, tuple(map(tuple, links)))
 
-    async def load_bots(self):
+    async def load_users(self):
         async with self.settings.db_session() as session:
-            self.bots = await Bot.get_active(session=session)
-            self.cur_bot = await self._find_cur_bot()
-
-        await self._update_bots_info()
-
-    async def get_bot_by_amount(self, amount: int) -> Bot | None:
-        for bot in self.bots:
-            if bot.is_running and bot.min_amount <= amount <= bot.max_amount:
-                return bot
-
-    async def _update_bots_info(self):
-        self.is_any_bot_active = False
-        self.all_active_bots_min_amount = None
-        self.all_active_bots_max_amount = None
-        for bot in self.bots:
-            if not bot.is_running:
-                continue
+            user_rows = await self._select_users(session)
+            links = await session.execute(self._select_links())
 
-            if self.all_active_bots_min_amount is None or self.all_active_bots_min_amount > bot.min_amount:
-                self.all_active_bots_min_amount = bot.min_amount
+        self._swap(self.config.bot_rows, user_rows, tuple(map(tuple, links)))
 
-            if self.all_active_bots_max_amount is None or self.all_active_bots_max_amount < bot.max_amount:
-                self.all_active_bots_max_amount = bot.max_amount
+    @staticmethod
+    def _select_links():
+        return select(user_bot_association.c.user_id, user_bot_association.c.bot_id).order_by(
+            user_bot_association.c.bot_id, user_bot_association.c.user_id)
 
-            self.is_any_bot_active = True
+    @staticmethod
+    async def _select_users(session, user_id: int | None = None) -> tuple:
+        query = select(*(getattr(User, name) for name in USER_FIELDS)).order_by(User.id)
+        if user_id is not None:
+            query = query.where(User.id == user_id)
+        result = await session.execute(query)
+        return tuple(map(tuple, result))
 
-    async def load_users(self):
+    async def reload_bot(self, bot_id: int):
+        """Перечитывает из БД только одного бота и его пользователей"""
+        await self.flush_writes()
+
+        async with self.settings.db_session() as session:
+            bot_rows = await session.execute(
+                select(*(getattr(Bot, name) for name in BOT_FIELDS)).where(Bot.id == bot_id, Bot.is_active)
+            )
+            links = await session.execute(self._select_links().where(user_bot_association.c.bot_id == bot_id))
+
+        config = self.config
+        self._swap(
+            _patch_rows(config.bot_rows, bot_id, tuple(map(tuple, bot_rows))),
+            config.user_rows,
+            _patch_rows(config.links, bot_id, tuple(map(tuple, links)), key_index=1),
+        )
+
+    async def reload_user(self, user_id: int):
         async with self.settings.db_session() as session:
-            self.users = await User.get_all(session=session)
+            user_rows = await self._select_users(session, user_id)
+
+        config = self.config
+        self._swap(config.bot_rows, _patch_rows(config.user_rows, user_id, user_rows), config.links)
+
+    async def _on_config_change(self, payload: dict):
+        if payload['table'] == 'users':
+            await self.reload_user(payload['id'])
+        else:
+            await self.reload_bot(payload['id'])
+
+    async def listen(self):
+        """
+        Подписка на LISTEN config_changes: изменения ботов и пользователей
+        прилетают от триггеров сразу после коммита.
+        """
+        url = self.settings.engine.url.set(drivername='postgresql')
+        while True:
+            try:
+                connection = await asyncpg.connect(url.render_as_string(hide_password=False))
+            except (OSError, asyncpg.PostgresError, SQLAlchemyError) as e:
+                self.settings.logger.error(f'LISTEN {CONFIG_CHANNEL} connect error: {e}')
+                await asyncio.sleep(5)
+                continue
+
+            queue = asyncio.Queue()
+            try:
+                await connection.add_listener(CONFIG_CHANNEL, lambda *args: queue.put_nowait(args[-1]))
+                # Пока подписки не было, изменения могли пройти мимо
+                await self.load_bots()
+                await self.load_users()
+                self.is_listening = True
+
+                while not connection.is_closed():
+                    try:
+                        payload = await asyncio.wait_for(queue.get(), 30)
+                    except asyncio.TimeoutError:
+                        continue
+                    await self._on_config_change(json.loads(payload))
+            # Ошибка перечитывания тоже ведет к переподключению: после него ботов и пользователей загрузим целиком
+            except (OSError, asyncpg.PostgresError, SQLAlchemyError) as e:
+                self.settings.logger.error(f'LISTEN {CONFIG_CHANNEL} error: {e}')
+            finally:
+                self.is_listening = False
+                try:
+                    await connection.close()
+                except (OSError, asyncpg.PostgresError):
+                    connection.terminate()
+
+            await asyncio.sleep(5)
+
+    async def get_bots_by_amount(self, amount: int, bank: str | None = None) -> list[BotConfig]:
+        bots = self.config.get_running_bots_by_amount(amount)
+        if bank is None:
+            return bots
+        return [bot for bot in bots if is_bank_allowed(bot.allowed_banks, bank)]
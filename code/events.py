@@ -0,0 +1,34 @@
+import dataclasses
+import enum
+from collections import defaultdict
+from typing import Callable
+
+
+class PayoutEventType(enum.Enum):
+    NEW = 'new'  # Новый платеж, который можно попробовать забрать
+    CLAIMED = 'claimed'  # Платеж числится забранным нами
+    DISAPPEARED = 'disappeared'  # Платеж пропал со страницы
+    EXPIRING = 'expiring'  # У забранного платежа заканчивается время для оплаты
+
+
+@dataclasses.dataclass(slots=True)
+class PayoutEvent:
+    type: PayoutEventType
+    payout_id: str
+    row: list | None = None
+    message: str | None = None
+
+
+class EventBus:
+    """Синхронная шина событий страницы платежей"""
+
+    def __init__(self):
+        self.subscribers: dict[PayoutEventType, list[Callable[[PayoutEvent], None]]] = defaultdict(list)
+
+    def subscribe(self, event_type: PayoutEventType, callback: Callable[[PayoutEvent], None]):
+        self.subscribers[event_type].append(callback)
+
+    def emit(self, event: PayoutEvent) -> PayoutEvent:
+        for callback in self.subscribers[event.type]:
+            callback(event)
+        return event
@@ -0,0 +1,137 @@
+import argparse
+import asyncio
+import csv
+import os
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import Boolean, Integer, String, TIMESTAMP, select, and_
+
+from code.logger import Logger
+from code.models import Payout
+from code.settings import Settings
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+EXPORT_FORMATS = ('csv', 'parquet')
+EXPORT_COLUMNS = [column.name for column in Payout.__table__.columns]
+
+
+class CsvWriter:
+    def __init__(self, path: str):
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(EXPORT_COLUMNS)
+
+    def write(self, rows: list):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+def parquet_schema():
+    """
+    Схема parquet по колонкам Payout. Из первой пачки ее выводить нельзя:
+    колонка, целиком пустая в первой пачке, получит тип null и следующие не запишутся
+    """
+    types = {Integer: pa.int64(), String: pa.string(), Boolean: pa.bool_(), TIMESTAMP: pa.timestamp('us')}
+    fields = []
+    for column in Payout.__table__.columns:
+        arrow_type = next((t for sa_type, t in types.items() if isinstance(column.type, sa_type)), pa.string())
+        fields.append(pa.field(column.name, arrow_type, nullable=column.nullable))
+    return pa.schema(fields)
+
+
+class ParquetWriter:
+    def __init__(self, path: str):
+        if pq is None:
+            raise ValueError('Для выгрузки в parquet нужен pyarrow')
+        self.path = path
+        self.schema = parquet_schema()
+        self.writer = None
+
+    def write(self, rows: list):
+        try:
+            table = pa.Table.from_pylist([dict(zip(EXPORT_COLUMNS, row)) for row in rows], schema=self.schema)
+        except pa.ArrowException as e:
+            raise ValueError(f'Не удалось записать платежи в parquet: {e}') from e
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, self.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def export_payouts(settings: Settings, path: str, date_from: date, date_to: date, fmt: str = 'csv',
+                         bot_name: str | None = None, chunk_size: int | None = None) -> int:
+    """
+    Выгружает платежи за [date_from, date_to] в файл, возвращает кол-во строк.
+
+    Строки читаются серверным курсором пачками по chunk_size, а пишутся в файл
+    в отдельном потоке, так что память не растет с размером выгрузки и event
+    loop не занят записью.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown export format: {fmt}')
+    if chunk_size is None:
+        chunk_size = int(os.getenv('EXPORT_CHUNK_SIZE', 10_000))
+
+    conditions = [
+        Payout.created_at >= datetime.combine(date_from, datetime.min.time()),
+        Payout.created_at < datetime.combine(date_to + timedelta(days=1), datetime.min.time()),
+    ]
+    if bot_name is not None:
+        conditions.append(Payout.bot_name == bot_name)
+
+    query = (select(*Payout.__table__.columns)
+             .where(and_(*conditions))
+             .order_by(Payout.created_at, Payout.id)
+             .execution_options(yield_per=chunk_size))
+
+    writer = CsvWriter(path) if fmt == 'csv' else ParquetWriter(path)
+    rows_count = 0
+    try:
+        async with settings.read_session() as session:
+            result = await session.stream(query)
+            async for rows in result.partitions(chunk_size):
+                await asyncio.to_thread(writer.write, [tuple(row) for row in rows])
+                rows_count += len(rows)
+    finally:
+        await asyncio.to_thread(writer.close)
+
+    return rows_count
+
+
+def parse_date(value: str) -> date:
+    return datetime.strptime(value, '%d.%m.%Y').date()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Выгрузка платежей в csv или parquet')
+    parser.add_argument('date_from', type=parse_date, help='дата начала, дд.мм.гггг')
+    parser.add_argument('date_to', type=parse_date, help='дата конца включительно, дд.мм.гггг')
+    parser.add_argument('-f', '--format', choices=EXPORT_FORMATS, default='csv')
+    parser.add_argument('-o', '--output', help='путь к файлу, по умолчанию payouts-<from>-<to>.<format>')
+    parser.add_argument('-b', '--bot', help='только платежи указанного бота')
+    parser.add_argument('--chunk-size', type=int)
+    args = parser.parse_args()
+
+    output = args.output or f'payouts-{args.date_from:%Y%m%d}-{args.date_to:%Y%m%d}.{args.format}'
+    settings = Settings(os.getenv('BOT_NAME', 'unknown'), Logger())
+    rows_count = await export_payouts(settings, output, args.date_from, args.date_to, args.format, args.bot,
+                                      args.chunk_size)
+    await settings.engine.dispose()
+    if settings.db_replica_url is not None:
+        await settings.replica_engine.dispose()
+    print(f'{rows_count} rows -> {output}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,53 @@
+import asyncio
+import threading
+from typing import Callable, Coroutine
+
+from code.settings import Settings
+
+
+class HotPathThread:
+    """
+    Отдельный поток со своим event loop под опрос и забор платежей.
+
+    Команды бота, статистика и рассылка уведомлений остаются в основном loop и
+    не могут задержать claim. Свой пул соединений с БД поток получает через
+    Settings.engine, с основным loop он общается только через потокобезопасные
+    Notifications, неизменяемый снимок конфига и run_coroutine_threadsafe в Tg.
+    """
+    settings: Settings
+    loop: asyncio.AbstractEventLoop | None = None
+
+    def __init__(self, settings: Settings, factories: list[Callable[[], Coroutine]]):
+        self.settings = settings
+        self.factories = factories
+        self.tasks = []
+        self.thread = threading.Thread(target=self._run, name='hot-path', daemon=True)
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._main())
+        finally:
+            self.loop.close()
+
+    async def _main(self):
+        self.tasks = [asyncio.create_task(factory()) for factory in self.factories]
+        try:
+            await asyncio.gather(*self.tasks)
+        finally:
+            await self.settings.engine.dispose()
+
+    def _cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def run(self):
+        self.thread.start()
+        try:
+            await asyncio.to_thread(self.thread.join)
+        except asyncio.CancelledError:
+            if self.loop is not None and not self.loop.is_closed():
+                self.loop.call_soon_threadsafe(self._cancel)
+            await asyncio.to_thread(self.thread.join)
+            raise
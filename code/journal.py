@@ -0,0 +1,230 @@
+import asyncio
+import json
+import os
+import struct
+import uuid
+import zlib
+from collections import Counter, deque
+
+from sqlalchemy import TIMESTAMP, cast, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import InterfaceError, OperationalError
+
+from code.models import Payout
+from code.settings import Settings
+
+# Заголовок записи: длина и crc32 тела
+HEADER = struct.Struct('>II')
+TIME_FIELDS = ('seen_at', 'attempt_seen_at', 'claim_sent_at', 'claim_answered_at', 'created_at')
+# Ошибки связи с БД: конкретная запись в них не виновата
+TRANSIENT_ERRORS = (OperationalError, InterfaceError, OSError, asyncio.TimeoutError)
+
+
+def encode_record(record: dict) -> bytes:
+    body = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode()
+    return HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_records(data: bytes) -> tuple[list[dict], int]:
+    """Разбирает записи журнала, возвращает их и длину целой части - дальше оборванный хвост"""
+    records = []
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        length, crc = HEADER.unpack_from(data, offset)
+        body = data[offset + HEADER.size:offset + HEADER.size + length]
+        if len(body) < length or zlib.crc32(body) != crc:
+            break
+        records.append(json.loads(body))
+        offset += HEADER.size + length
+    return records, offset
+
+
+class ClaimJournal:
+    """
+    Локальный журнал исходов claim.
+
+    Запись платежа сначала дописывается в файл, а в payouts уходит в фоне
+    пачками, так что подвисшая или упавшая БД не держит цикл забора и не теряет
+    строки. fsync делается пачкой раз в fsync_interval. У каждой записи свой
+    journal_id, вставка идет через ON CONFLICT DO NOTHING, поэтому повторная
+    отправка после рестарта ничего не задваивает. Когда все отправлено, файл
+    обнуляется.
+
+    Если пачка не вставилась не из-за связи с БД, записи отправляются по одной,
+    чтобы одна битая запись не держала остальные. Запись, не вставшую
+    max_attempts раз, откладываем в dead letter файл и сообщаем админам.
+    """
+    settings: Settings
+
+    def __init__(self, settings: Settings, path: str | None = None):
+        self.settings = settings
+        self.path = path or os.getenv('CLAIM_JOURNAL_PATH', 'claims.journal')
+        self.fsync_interval = float(os.getenv('CLAIM_JOURNAL_FSYNC_INTERVAL', 0.05))
+        self.batch_size = int(os.getenv('CLAIM_JOURNAL_BATCH_SIZE', 500))
+        self.retry_interval = float(os.getenv('CLAIM_JOURNAL_RETRY_INTERVAL', 5))
+        self.max_attempts = int(os.getenv('CLAIM_JOURNAL_MAX_ATTEMPTS', 3))
+        self.dead_letter_path = os.getenv('CLAIM_JOURNAL_DEAD_LETTER_PATH', f'{self.path}.dead')
+
+        self._pending = deque()
+        # Неудачные попытки вставки по journal_id
+        self._attempts = Counter()
+        self._is_dirty = False
+        self._wakeup = asyncio.Event()
+        self.file = None
+
+    def _open(self):
+        """Поднимает неотправленные записи прошлого запуска и отрезает оборванный хвост"""
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+
+        records, size = decode_records(data)
+        self._pending.extend(records)
+
+        self.file = open(self.path, 'ab')
+        if size < len(data):
+            self.settings.logger.error(f'Claim journal: отрезано {len(data) - size} байт оборванного хвоста')
+            self.file.truncate(size)
+
+        if records:
+            self.settings.logger.info(f'Claim journal: к повторной отправке {len(records)} записей')
+
+    def append(self, record: dict) -> dict:
+        if self.file is None:
+            self._open()
+
+        record.setdefault('journal_id', uuid.uuid4().hex)
+        self.file.write(encode_record(record))
+        self.file.flush()
+        self._is_dirty = True
+
+        self._pending.append(record)
+        self._wakeup.set()
+        return record
+
+    async def _sync(self):
+        if self._is_dirty:
+            self._is_dirty = False
+            await asyncio.to_thread(os.fsync, self.file.fileno())
+
+    async def _ship(self, records: list[dict]):
+        rows = []
+        spans = []
+        for record in records:
+            row = dict(record)
+            trace_id = row.pop('trace_id', None)
+            if trace_id is not None:
+                spans.append(self.settings.tracer.span(
+                    'payout_write', trace_id, journal_id=row['journal_id'], batch=len(records)))
+            # Время в журнале - unix time. В timestamp его переводит сама БД в своем часовом поясе,
+            # как и CURRENT_TIMESTAMP у прежних строк, так что пояс хоста бота ни на что не влияет
+            for name in TIME_FIELDS:
+                if row.get(name) is not None:
+                    row[name] = cast(func.to_timestamp(row[name]), TIMESTAMP)
+            rows.append(row)
+
+        try:
+            async with self.settings.db_session() as session:
+                await session.execute(
+                    insert(Payout).values(rows).on_conflict_do_nothing(index_elements=['journal_id', 'created_at'])
+                )
+                await session.commit()
+        except Exception as e:
+            for span in spans:
+                span.set('error', repr(e))
+            raise
+        finally:
+            for span in spans:
+                span.end()
+
+    async def _ship_separately(self, records: list[dict]) -> list[dict]:
+        """Отправляет записи по одной, возвращает те, что надо повторить"""
+        failed = []
+        for i, record in enumerate(records):
+            journal_id = record['journal_id']
+            try:
+                await self._ship([record])
+            except TRANSIENT_ERRORS as e:
+                # БД отвалилась посреди отправки - остаток повторим целиком
+                self.settings.logger.error(f'Claim journal ship error: {e}')
+                failed.extend(records[i:])
+                break
+            except Exception as e:
+                self._attempts[journal_id] += 1
+                if self._attempts[journal_id] < self.max_attempts:
+                    failed.append(record)
+                    continue
+                del self._attempts[journal_id]
+                await self._dead_letter(record, e)
+            else:
+                self._attempts.pop(journal_id, None)
+        return failed
+
+    async def _dead_letter(self, record: dict, error: Exception):
+        """Откладывает запись в отдельный файл в том же формате, что и журнал"""
+        def write():
+            with open(self.dead_letter_path, 'ab') as f:
+                f.write(encode_record(record))
+                f.flush()
+                os.fsync(f.fileno())
+
+        await asyncio.to_thread(write)
+        self.settings.metrics.inc('journal.dead_letters')
+        self.settings.logger.error(f'Claim journal: запись {record["journal_id"]} отложена в '
+                                   f'{self.dead_letter_path}: {error}')
+        self.settings.notifications.add_to_admins(
+            f'❗️Не удалось записать платеж в БД после {self.max_attempts} попыток\n'
+            f'Operation ID: {record.get("operation_id")} Сумма: {record.get("amount")}\n'
+            f'Запись отложена в {self.dead_letter_path}: {error}'
+        )
+
+    async def run(self):
+        if self.file is None:
+            self._open()
+
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.fsync_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+
+                await self._sync()
+                if not self._pending:
+                    continue
+
+                records = [self._pending[i] for i in range(min(self.batch_size, len(self._pending)))]
+                try:
+                    await self._ship(records)
+                    failed = []
+                except TRANSIENT_ERRORS as e:
+                    self.settings.logger.error(f'Claim journal ship error: {e}')
+                    self.settings.metrics.inc('journal.ship_errors')
+                    await asyncio.sleep(self.retry_interval)
+                    continue
+                except Exception as e:
+                    self.settings.logger.error(f'Claim journal ship error, отправляем по одной: {e}')
+                    self.settings.metrics.inc('journal.ship_errors')
+                    failed = await self._ship_separately(records)
+
+                # Пока шла отправка, новые записи добавлялись только в хвост
+                for _ in records:
+                    self._pending.popleft()
+                self._pending.extendleft(reversed(failed))
+                self.settings.metrics.inc('journal.shipped', len(records) - len(failed))
+                self.settings.metrics.set('journal.pending', len(self._pending))
+                if failed:
+                    await asyncio.sleep(self.retry_interval)
+                    continue
+
+                # Все отправлено, а новые записи между await сюда не попали - журнал можно обнулить
+                if not self._pending:
+                    self.file.truncate(0)
+                    self._is_dirty = False
+        finally:
+            await self._sync()
+            self.file.close()
+            self.file = None
@@ -0,0 +1,62 @@
+import threading
+from collections import deque
+
+
+class Histogram:
+    """Скользящее окно последних значений с перцентилями"""
+    __slots__ = ('values', 'count', 'total')
+
+    def __init__(self, size: int = 1000):
+        self.values = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.values.append(value)
+        self.count += 1
+        self.total += value
+
+    def percentile(self, q: float) -> float | None:
+        if not self.values:
+            return None
+        values = sorted(self.values)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Metrics:
+    counters: dict[str, float]
+    gauges: dict[str, float]
+    histograms: dict[str, Histogram]
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name: str, value: float):
+        self.gauges[name] = value
+
+    def observe(self, name: str, value: float):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        histogram.observe(value)
+
+    def report(self) -> str:
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append(f'{name}: {value:g}')
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f'{name}: {value:g}')
+        for name, histogram in sorted(self.histograms.items()):
+            if not histogram.count:
+                continue
+            p50, p90, p99 = (histogram.percentile(q) for q in (0.5, 0.9, 0.99))
+            lines.append(f'{name}: n={histogram.count} p50={p50:.1f} p90={p90:.1f} p99={p99:.1f}')
+        return '\n'.join(lines)
@@ -1,8 +1,9 @@
 import enum
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Sequence
 
-from sqlalchemy import Column, Integer, Boolean, String, TIMESTAMP, and_, Table, ForeignKey, select, update, or_
+from sqlalchemy import Column, Integer, Boolean, String, TIMESTAMP, and_, Table, ForeignKey, select, update, or_, delete, insert, \
+    case
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy.sql import func
@@ -42,6 +43,25 @@ class User(Base):
         result = await session.execute(select(User).filter(User.bots.any(Bot.id.in_([bot_id]))))
         return result.scalars().all()
 
+    @classmethod
+    async def get_page(cls, session: AsyncSession, offset: int, limit: int) -> Sequence['User']:
+        result = await session.execute(select(User).order_by(cls.id).offset(offset).limit(limit))
+        return result.scalars().all()
+
+    @classmethod
+    async def get_count(cls, session: AsyncSession) -> int:
+        result = await session.execute(select(func.count(cls.id)))
+        return result.scalar()
+
+    @classmethod
+    async def get_ids_in_bot(cls, session: AsyncSession, bot_id: int, user_ids: list[int]) -> set[int]:
+        """Какие из переданных пользователей добавлены в бота"""
+        result = await session.execute(select(user_bot_association.c.user_id).where(and_(
+            user_bot_association.c.bot_id == bot_id,
+            user_bot_association.c.user_id.in_(user_ids),
+        )))
+        return set(result.scalars())
+
 
 class Bot(Base):
     __tablename__ = 'bots'
@@ -62,6 +82,12 @@ class Bot(Base):
 
     claimed_payouts_limit = Column(Integer, nullable=False)
     claimed_payouts_count = Column(Integer, nullable=False, default=0)
+    # Слоты, занятые под claim, которые еще не видны в claimed_payouts_count
+    reserved_claims_count = Column(Integer, nullable=False, default=0, server_default='0')
+    reserved_claims_at = Column(TIMESTAMP, nullable=True)
+
+    # Список банков через запятую, None - список по умолчанию
+    allowed_banks = Column(String, nullable=True)
 
     users = relationship('User', secondary=user_bot_association, back_populates='bots', lazy='subquery')
 
@@ -75,35 +101,86 @@ class Bot(Base):
         result = await session.execute(select(Bot).filter(cls.id == bot_id))
         return result.scalars().first()
 
-    async def add_user(self, session: AsyncSession, user: User):
-        """Add user to bot's user list"""
-        if user not in self.users:
-            self.users.append(user)
-            await session.commit()
-
-    async def remove_user(self, session: AsyncSession, user: User):
-        """Remove user from bot's user list"""
-        if user in self.users:
-            self.users.remove(user)
-            await session.commit()
+    @classmethod
+    async def toggle_user(cls, session: AsyncSession, bot_id: int, user_id: int) -> bool:
+        """Добавляет пользователя в бота или убирает, если он там уже есть; возвращает новое состояние"""
+        result = await session.execute(delete(user_bot_association).where(and_(
+            user_bot_association.c.bot_id == bot_id,
+            user_bot_association.c.user_id == user_id,
+        )))
+        if result.rowcount:
+            return False
 
-    async def set_is_running(self, session: AsyncSession, is_running: bool):
-        await session.execute(update(Bot).where(Bot.id == self.id).values(is_running=is_running))
+        await session.execute(insert(user_bot_association).values(bot_id=bot_id, user_id=user_id))
+        return True
 
-    async def set_min_amount(self, session: AsyncSession, min_amount: int):
-        await session.execute(update(Bot).where(Bot.id == self.id).values(min_amount=min_amount))
+    @classmethod
+    async def set_values(cls, session: AsyncSession, bot_id: int, **values):
+        await session.execute(update(Bot).where(Bot.id == bot_id).values(**values))
 
-    async def set_max_amount(self, session: AsyncSession, max_amount: int):
-        await session.execute(update(Bot).where(Bot.id == self.id).values(max_amount=max_amount))
+    @classmethod
+    async def reserve_claim_slots(cls, session: AsyncSession, requested: dict[int, int]) -> dict[int, int]:
+        """
+        Атомарно занимает слоты под claim: по каждому боту выдается не больше,
+        чем осталось до claimed_payouts_limit с учетом уже забранных и занятых.
+        Строки ботов блокируются на время транзакции, так что параллельные
+        процессы не превысят лимит.
+
+        :param requested: сколько слотов нужно по id бота
+        :return: сколько выдано по id бота
+        """
+        granted = func.least(
+            case(requested, value=cls.id),
+            func.greatest(cls.claimed_payouts_limit - cls.claimed_payouts_count - cls.reserved_claims_count, 0),
+        )
+        cur = select(cls.id, granted.label('granted')).where(cls.id.in_(requested)).with_for_update().cte('cur')
+
+        result = await session.execute(
+            update(Bot)
+            .where(Bot.id == cur.c.id)
+            .values(
+                reserved_claims_count=Bot.reserved_claims_count + cur.c.granted,
+                # Время брони обновляем только при выдаче, иначе потерянная бронь никогда не устареет
+                reserved_claims_at=case((cur.c.granted > 0, func.now()), else_=Bot.reserved_claims_at),
+            )
+            .returning(Bot.id, cur.c.granted)
+        )
+        return {bot_id: granted for bot_id, granted in result.all()}
 
-    async def set_claimed_payouts_count(self, session: AsyncSession, claimed_payouts_count: int):
-        await session.execute(update(Bot).where(Bot.id == self.id).values(claimed_payouts_count=claimed_payouts_count))
+    @classmethod
+    async def release_claim_slots(cls, session: AsyncSession, bot_id: int, count: int = 1):
+        await session.execute(update(Bot).where(Bot.id == bot_id).values(
+            reserved_claims_count=func.greatest(Bot.reserved_claims_count - count, 0)
+        ))
 
-    async def set_claimed_payouts_limit(self, session: AsyncSession, claimed_payouts_limit: int):
-        await session.execute(update(Bot).where(Bot.id == self.id).values(claimed_payouts_limit=claimed_payouts_limit))
+    @classmethod
+    async def sync_claimed_payouts_count(cls, session: AsyncSession, bot_id: int, claimed_payouts_count: int,
+                                         newly_claimed: int, reservation_ttl: int):
+        """
+        Пишет кол-во забранных со страницы бота и в той же транзакции снимает
+        брони, которые теперь в нем учтены. Брони, к которым давно не добавлялось
+        новых, считаются потерянными (процесс упал между броней и claim) и
+        обнуляются. Без изменений строку не трогаем.
+
+        :param newly_claimed: сколько платежей стали забранными с прошлой записи
+        :param reservation_ttl: через сколько секунд без новых броней они сбрасываются
+        """
+        is_stale = cls.reserved_claims_at < func.now() - timedelta(seconds=reservation_ttl)
+        conditions = [cls.claimed_payouts_count != claimed_payouts_count, and_(cls.reserved_claims_count > 0, is_stale)]
+        if newly_claimed > 0:
+            conditions.append(cls.reserved_claims_count > 0)
+
+        await session.execute(update(Bot).where(and_(Bot.id == bot_id, or_(*conditions))).values(
+            claimed_payouts_count=claimed_payouts_count,
+            reserved_claims_count=case(
+                (is_stale, 0),
+                else_=func.greatest(cls.reserved_claims_count - newly_claimed, 0),
+            ),
+        ))
 
-    async def set_auth_cookie(self, session: AsyncSession, auth_cookie: str | None):
-        await session.execute(update(Bot).where(Bot.id == self.id).values(auth_cookie=auth_cookie))
+    @classmethod
+    async def set_auth_cookie(cls, session: AsyncSession, bot_id: int, auth_cookie: str | None):
+        await session.execute(update(Bot).where(Bot.id == bot_id).values(auth_cookie=auth_cookie))
 
 
 class PayoutActionEnum(enum.Enum):
@@ -134,10 +211,25 @@ class Payout(Base):
 
     is_gained_and_notified = Column(Boolean, nullable=False, default=False)
 
-    created_at = Column(TIMESTAMP, server_default=func.current_timestamp())
+    # Тайминги гонки за платежом: время строки у turcode, первое появление в нашем опросе,
+    # отправка claim и ответ на него
+    upstream_time = Column(String, nullable=True)
+    seen_at = Column(TIMESTAMP, nullable=True)
+    # Появление в опросе, после которого сделана эта попытка; при повторных попытках позже seen_at
+    attempt_seen_at = Column(TIMESTAMP, nullable=True)
+    claim_sent_at = Column(TIMESTAMP, nullable=True)
+    claim_answered_at = Column(TIMESTAMP, nullable=True)
+    # id записи локального журнала claim, по нему повторная отправка не задваивает строки
+    journal_id = Column(String, nullable=True)
+
+    # Таблица разбита на месячные партиции по created_at, поэтому он входит в первичный ключ
+    created_at = Column(TIMESTAMP, primary_key=True, server_default=func.current_timestamp())
 
     async def set_is_gained_and_notified(self, session: AsyncSession, is_gained_and_notified: bool):
-        await session.execute(update(Payout).where(Payout.id == self.id).values(is_gained_and_notified=is_gained_and_notified))
+        await session.execute(update(Payout).where(and_(
+            Payout.id == self.id,
+            Payout.created_at == self.created_at,
+        )).values(is_gained_and_notified=is_gained_and_notified))
 
     @classmethod
     async def get_not_gained_by_operation_id(cls, session: AsyncSession, operation_id: str) -> Sequence['Payout']:
@@ -199,3 +291,33 @@ class Payout(Base):
 
         )).order_by(cls.created_at.desc()))
         return result.scalars().all()
+
+    @classmethod
+    async def get_race_stats(cls, session: AsyncSession, bot_name: str, since: datetime) -> dict[int, dict]:
+        def ms(end, start):
+            return func.extract('epoch', end - start) * 1000
+
+        intervals = {
+            # Маршрутизация считается от опроса этой попытки, чтобы не мешать ее с ожиданием повторов
+            'route': ms(cls.claim_sent_at, func.coalesce(cls.attempt_seen_at, cls.seen_at)),
+            'claim': ms(cls.claim_answered_at, cls.claim_sent_at),
+            'total': ms(cls.claim_answered_at, cls.seen_at),
+        }
+        columns = [cls.action, func.count(cls.id)]
+        for expr in intervals.values():
+            for q in (0.5, 0.9, 0.99):
+                columns.append(func.percentile_cont(q).within_group(expr))
+
+        result = await session.execute(select(*columns).where(and_(
+            cls.bot_name == bot_name,
+            cls.created_at >= since,
+            cls.seen_at.is_not(None),
+            cls.claim_answered_at.is_not(None),
+        )).group_by(cls.action))
+
+        stats = {}
+        for action, count, *values in result.all():
+            stats[action] = {'count': count}
+            for i, name in enumerate(intervals):
+                stats[action][name] = values[i * 3:i * 3 + 3]
+        return stats
@@ -0,0 +1,76 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+
+from code.settings import Settings
+
+
+class LoopLagMonitor:
+    """
+    Следит за задержкой планирования event loop.
+
+    Задача в loop периодически засыпает на interval и меряет, насколько позже
+    проснулась. Параллельно сторожевой поток смотрит на heartbeat задачи и,
+    если loop завис дольше threshold, снимает стек потока loop - это стек
+    того колбэка, который его блокирует.
+    """
+    settings: Settings
+
+    def __init__(self, settings: Settings, name: str = 'main'):
+        self.settings = settings
+        self.name = name
+        # Метрики основного loop остаются под прежними именами
+        self.metrics_prefix = 'loop' if name == 'main' else f'loop.{name}'
+        self.interval = float(os.getenv('LOOP_LAG_INTERVAL', 0.1))
+        self.threshold = float(os.getenv('LOOP_LAG_THRESHOLD', 0.2))
+        self.notify_interval = int(os.getenv('LOOP_LAG_NOTIFY_INTERVAL', 10 * 60))
+
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id = None
+        self.stack = None
+        self.last_notified = 0.0
+        self._stopped = threading.Event()
+
+    def _watchdog(self):
+        while not self._stopped.wait(self.threshold / 2):
+            if self.stack is not None:
+                continue
+            if time.monotonic() - self.heartbeat < self.interval + self.threshold:
+                continue
+
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                self.stack = ''.join(traceback.format_stack(frame))
+
+    def _report(self, lag: float):
+        self.settings.metrics.inc(f'{self.metrics_prefix}.stalls')
+        stack = self.stack or 'стек не снят'
+        self.settings.logger.error(f'Event loop {self.name} lag {lag * 1000:.0f} ms\n{stack}')
+
+        now_time = time.monotonic()
+        if now_time - self.last_notified >= self.notify_interval:
+            self.last_notified = now_time
+            self.settings.notifications.add_to_admins(
+                f'⚠️ Event loop {self.name} завис на {lag * 1000:.0f} мс\n\n{stack[-3000:]}'
+            )
+
+    async def run(self):
+        self.loop_thread_id = threading.get_ident()
+        thread = threading.Thread(target=self._watchdog, name=f'loop-lag-watchdog-{self.name}', daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                self.heartbeat = started = time.monotonic()
+                await asyncio.sleep(self.interval)
+                lag = time.monotonic() - started - self.interval
+
+                self.settings.metrics.observe(f'{self.metrics_prefix}.lag_ms', lag * 1000)
+                if lag > self.threshold:
+                    self._report(lag)
+                self.stack = None
+        finally:
+            self._stopped.set()
@@ -0,0 +1,94 @@
+import asyncio
+import os
+from datetime import date
+
+from sqlalchemy import text
+
+from code.settings import Settings
+
+# Ключ advisory lock, чтобы обслуживанием партиций занимался один процесс
+PARTITIONS_LOCK_ID = 0x70617974
+
+RETENTION_DETACH = 'detach'
+RETENTION_DROP = 'drop'
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f'payouts_p{month:%Y%m}'
+
+
+class PartitionManager:
+    """
+    Обслуживание месячных партиций payouts.
+
+    Заранее создает партиции на months_ahead месяцев вперед, а партиции старше
+    retention_months отцепляет в схему payouts_archive или удаляет.
+    retention_months=0 хранит все.
+    """
+    settings: Settings
+
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self.months_ahead = int(os.getenv('PAYOUTS_PARTITIONS_AHEAD', 3))
+        self.retention_months = int(os.getenv('PAYOUTS_RETENTION_MONTHS', 0))
+        self.retention_mode = os.getenv('PAYOUTS_RETENTION_MODE', RETENTION_DETACH)
+        self.interval = int(os.getenv('PAYOUTS_PARTITIONS_INTERVAL', 24 * 60 * 60))
+
+        if self.retention_mode not in (RETENTION_DETACH, RETENTION_DROP):
+            raise ValueError(f'Unknown payouts retention mode: {self.retention_mode}')
+
+    async def maintain(self, today: date | None = None) -> bool:
+        today = today or date.today()
+        month = today.replace(day=1)
+
+        async with self.settings.engine.begin() as conn:
+            is_locked = await conn.scalar(text('SELECT pg_try_advisory_xact_lock(:id)'), {'id': PARTITIONS_LOCK_ID})
+            if not is_locked:
+                return False
+
+            for i in range(self.months_ahead + 1):
+                start = add_months(month, i)
+                await conn.execute(text(
+                    f'CREATE TABLE IF NOT EXISTS {partition_name(start)} PARTITION OF payouts '
+                    f"FOR VALUES FROM ('{start}') TO ('{add_months(start, 1)}')"
+                ))
+
+            if self.retention_months > 0:
+                await self._apply_retention(conn, add_months(month, -self.retention_months))
+
+        return True
+
+    async def _apply_retention(self, conn, cutoff: date):
+        result = await conn.execute(text("""
+            SELECT child.relname FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE parent.relname = 'payouts' AND child.relname LIKE 'payouts_p%'
+        """))
+
+        if self.retention_mode == RETENTION_DETACH:
+            await conn.execute(text('CREATE SCHEMA IF NOT EXISTS payouts_archive'))
+
+        for name in sorted(result.scalars()):
+            if name >= partition_name(cutoff):
+                continue
+
+            await conn.execute(text(f'ALTER TABLE payouts DETACH PARTITION {name}'))
+            if self.retention_mode == RETENTION_DROP:
+                await conn.execute(text(f'DROP TABLE {name}'))
+            else:
+                await conn.execute(text(f'ALTER TABLE {name} SET SCHEMA payouts_archive'))
+            self.settings.logger.info(f'Partition {name} retention: {self.retention_mode}')
+
+    async def run(self):
+        while True:
+            try:
+                await self.maintain()
+            except Exception as e:
+                self.settings.logger.error('Partitions maintenance error:', e)
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,117 @@
+import os
+from collections import deque
+
+OBJECTIVE_AMOUNT = 'amount'
+OBJECTIVE_COUNT = 'count'
+
+
+class ClaimPlanner:
+    """
+    Распределяет пачку платежей по ботам с учетом оставшихся слотов.
+
+    Платежи перебираются в порядке приоритета, для каждого ищется цепочка
+    переназначений между ботами, освобождающая слот. Допустимые назначения
+    образуют трансверсальный матроид, поэтому план всегда содержит
+    максимально возможное кол-во платежей, а при objective=amount из всех
+    таких планов выбирается план с максимальной суммой. При objective=count
+    приоритет у платежей в порядке страницы.
+    """
+    objective: str
+
+    def __init__(self, objective: str | None = None):
+        if objective is None:
+            objective = os.getenv('CLAIM_PLANNER_OBJECTIVE', OBJECTIVE_AMOUNT)
+        if objective not in (OBJECTIVE_AMOUNT, OBJECTIVE_COUNT):
+            raise ValueError(f'Unknown claim planner objective: {objective}')
+        self.objective = objective
+
+    def plan(self, items: list[tuple[object, int, list]], capacities: dict[int, int]) -> list[tuple[object, object]]:
+        """
+        :param items: список (платеж, сумма, подходящие боты)
+        :param capacities: оставшиеся слоты по id бота
+        :return: список (платеж, бот)
+        """
+        order = range(len(items))
+        if self.objective == OBJECTIVE_AMOUNT:
+            order = sorted(order, key=lambda i: items[i][1], reverse=True)
+
+        free = dict(capacities)
+        # Назначенные платежи по ботам, сгруппированные по набору подходящих ботов
+        assigned: dict[int, dict[tuple, set[int]]] = {}
+        item_bot: dict[int, object] = {}
+        # Боты, из которых нет пути до свободного слота; такими они остаются до конца
+        dead: set[int] = set()
+
+        for i in order:
+            if items[i][2]:
+                self._augment(i, items, free, assigned, item_bot, dead)
+
+        return [(items[i][0], item_bot[i]) for i in sorted(item_bot)]
+
+    @staticmethod
+    def _augment(i: int, items: list, free: dict, assigned: dict, item_bot: dict, dead: set) -> bool:
+        # BFS по ботам: parents[бот] = (бот, из которого в него переезжает платеж, платеж)
+        parents = {}
+        queue = deque()
+        for bot in items[i][2]:
+            if bot.id not in parents and bot.id not in dead:
+                parents[bot.id] = (None, i)
+                queue.append(bot)
+
+        while queue:
+            bot = queue.popleft()
+            if free.get(bot.id, 0) > 0:
+                free[bot.id] -= 1
+                while bot is not None:
+                    prev_bot, item = parents[bot.id]
+                    key = tuple(b.id for b in items[item][2])
+                    if prev_bot is not None:
+                        assigned[prev_bot.id][key].discard(item)
+                    assigned.setdefault(bot.id, {}).setdefault(key, set()).add(item)
+                    item_bot[item] = bot
+                    bot = prev_bot
+                return True
+
+            for group in assigned.get(bot.id, {}).values():
+                if not group:
+                    continue
+                item = next(iter(group))
+                for next_bot in items[item][2]:
+                    if next_bot.id not in parents and next_bot.id not in dead:
+                        parents[next_bot.id] = (bot, item)
+                        queue.append(next_bot)
+
+        dead.update(parents)
+        return False
+
+
+if __name__ == '__main__':
+    # Бенчмарк на синтетической пачке: python -m code.planner [кол-во платежей] [кол-во ботов]
+    import random
+    import sys
+    import time
+    from types import SimpleNamespace
+
+    payouts_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    bots_count = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    random.seed(0)
+    bots = []
+    for bot_id in range(bots_count):
+        min_amount = random.randrange(0, 90_000, 5_000)
+        bots.append(SimpleNamespace(id=bot_id, min_amount=min_amount, max_amount=min_amount + 30_000))
+
+    items = []
+    for payout_id in range(payouts_count):
+        amount = random.randrange(1_000, 120_000)
+        eligible = [bot for bot in bots if bot.min_amount <= amount <= bot.max_amount]
+        items.append((payout_id, amount, eligible))
+
+    capacities = {bot.id: random.randint(1, payouts_count // bots_count) for bot in bots}
+
+    for objective in (OBJECTIVE_AMOUNT, OBJECTIVE_COUNT):
+        start_time = time.perf_counter()
+        result = ClaimPlanner(objective).plan(items, capacities)
+        elapsed = time.perf_counter() - start_time
+        amounts = {payout_id: amount for payout_id, amount, _ in items}
+        print(f'{objective}: {len(result)} платежей, сумма {sum(amounts[p] for p, _ in result)}, {elapsed * 1000:.1f} мс')
@@ -0,0 +1,40 @@
+import os
+
+
+class PageSizer:
+    """
+    Длина страницы payouts.php под текущую нагрузку.
+
+    Полная страница значит, что часть строк могла не влезть - длину удваиваем.
+    Если страница заполнена меньше чем наполовину, плавно ужимаем на четверть,
+    чтобы не гонять и не разбирать пустой хвост.
+    """
+    min_length: int
+    max_length: int
+    length: int
+
+    def __init__(self, min_length: int | None = None, max_length: int | None = None):
+        self.min_length = min_length if min_length is not None else int(os.getenv('PAYOUTS_PAGE_MIN', 20))
+        self.max_length = max_length if max_length is not None else int(os.getenv('PAYOUTS_PAGE_MAX', 400))
+        self.length = min(self.max_length, max(self.min_length, 100))
+
+    def update(self, rows_count: int) -> bool:
+        """Подстраивает длину по кол-ву строк прошлого опроса, возвращает признак обрезанной страницы"""
+        if rows_count >= self.length:
+            self.length = min(self.max_length, self.length * 2)
+            return True
+
+        if rows_count < self.length // 2:
+            self.length = max(self.min_length, self.length * 3 // 4)
+        return False
+
+
+def split_windows(windows: tuple[tuple[int, int], ...], min_gap: int) -> list[tuple[int, int]]:
+    """Склеивает окна сумм ботов, между которыми разрыв меньше min_gap - отдельный запрос того не стоит"""
+    result = []
+    for min_amount, max_amount in windows:
+        if result and min_amount - result[-1][1] < min_gap:
+            result[-1] = (result[-1][0], max(result[-1][1], max_amount))
+        else:
+            result.append((min_amount, max_amount))
+    return result
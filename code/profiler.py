@@ -0,0 +1,106 @@
+import asyncio
+import os
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class SamplingProfiler:
+    """
+    Семплирующий профайлер живого процесса.
+
+    Отдельный поток раз в interval снимает стеки всех потоков через
+    sys._current_frames, сам процесс при этом не останавливается. Результат -
+    свернутые стеки (формат flamegraph.pl / speedscope) и топ функций.
+    """
+    interval: float
+    stacks: Counter
+    samples: int
+
+    def __init__(self, interval: float | None = None):
+        if interval is None:
+            interval = float(os.getenv('PROFILE_INTERVAL', 0.005))
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stopped = threading.Event()
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            self.stacks[tuple(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._sample()
+
+    async def profile(self, seconds: float):
+        thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        thread.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self._stopped.set()
+            await asyncio.to_thread(thread.join)
+
+    def collapsed(self) -> str:
+        return ''.join(f'{';'.join(stack)} {count}\n' for stack, count in self.stacks.most_common())
+
+    def summary(self, top: int = 15) -> str:
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for name in set(stack[1:]):
+                total[name] += count
+
+        samples = sum(self.stacks.values()) or 1
+        lines = [f'Семплов: {self.samples}, стеков: {samples}', '', 'Собственное время:']
+        lines += [f'{count * 100 / samples:5.1f}% {name}' for name, count in own.most_common(top)]
+        lines += ['', 'Общее время:']
+        lines += [f'{count * 100 / samples:5.1f}% {name}' for name, count in total.most_common(top)]
+        return '\n'.join(lines)
+
+
+class MemoryTracker:
+    """Снимки tracemalloc, каждый следующий сравнивается с предыдущим"""
+    snapshot: tracemalloc.Snapshot | None = None
+
+    def __init__(self, frames: int | None = None):
+        self.frames = frames if frames is not None else int(os.getenv('TRACEMALLOC_FRAMES', 10))
+
+    def stop(self):
+        tracemalloc.stop()
+        self.snapshot = None
+
+    def diff(self, top: int = 15) -> str:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.snapshot = tracemalloc.take_snapshot()
+            return 'tracemalloc запущен, повторите команду позже, чтобы увидеть прирост'
+
+        snapshot = tracemalloc.take_snapshot()
+        stats = snapshot.compare_to(self.snapshot, 'lineno')
+        self.snapshot = snapshot
+
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f'Сейчас: {current / 1024 / 1024:.1f} МБ, пик: {peak / 1024 / 1024:.1f} МБ', '']
+        lines += [str(stat) for stat in stats[:top]]
+        return '\n'.join(lines)
@@ -0,0 +1,68 @@
+import asyncio
+import heapq
+import time
+from typing import Callable
+
+EXPIRY_REMINDERS = [
+    ('Осталось 15 минут', 15 * 60),
+    ('Осталось 5 минут', 5 * 60),
+]
+
+
+class ReminderScheduler:
+    """
+    Таймеры напоминаний об истечении времени оплаты на куче.
+
+    На каждый платеж таймеры ставятся один раз (по одному на порог), отмена
+    ленивая - устаревшие записи просто пропускаются при извлечении из кучи.
+    """
+    thresholds: list
+
+    def __init__(self, thresholds: list = None):
+        self.thresholds = thresholds if thresholds is not None else EXPIRY_REMINDERS
+        self._heap = []
+        self._timers: dict[str, int] = {}
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+
+    def register(self, payout_id: str, end_time: float, payload=None) -> bool:
+        if payout_id in self._timers:
+            return False
+
+        self._seq += 1
+        self._timers[payout_id] = self._seq
+
+        now_time = time.time()
+        for msg_text, threshold in self.thresholds:
+            fire_at = end_time - threshold
+            # Порог уже пройден, напоминание было бы неправдой
+            if fire_at <= now_time:
+                continue
+            heapq.heappush(self._heap, (fire_at, self._seq, msg_text, payout_id, payload))
+
+        self._wakeup.set()
+        return True
+
+    def cancel(self, payout_id: str):
+        self._timers.pop(payout_id, None)
+
+    def pop_due(self, now_time: float) -> list[tuple[str, str, object]]:
+        due = []
+        while self._heap and self._heap[0][0] <= now_time:
+            _, seq, msg_text, payout_id, payload = heapq.heappop(self._heap)
+            if self._timers.get(payout_id) == seq:
+                due.append((payout_id, msg_text, payload))
+        return due
+
+    async def run(self, callback: Callable[[str, str, object], None]):
+        while True:
+            now_time = time.time()
+            for payout_id, msg_text, payload in self.pop_due(now_time):
+                callback(payout_id, msg_text, payload)
+
+            timeout = self._heap[0][0] - now_time if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
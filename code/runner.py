@@ -2,10 +2,16 @@ import asyncio
 import time
 from typing import Sequence
 
+from sqlalchemy.exc import SQLAlchemyError
+
 from code.api import API
 from code.db import DB
+from code.hotpath import HotPathThread
 from code.models import Bot, User
+from code.monitor import LoopLagMonitor
+from code.partitions import PartitionManager
 from code.settings import Settings
+from code.startup import startup
 from code.tg import Tg
 
 
@@ -26,33 +32,117 @@ class Runner:
         self.tg = tg
         self.extra_update_last_fast_run = int(time.time())
         self.extra_update_last_slow_run = int(time.time())
+        self.config_last_resync = int(time.time())
 
     async def fetch_turcode_api(self):
         try:
             while True:
                 if not self.db.is_any_bot_active:
+                    startup.ready(self.settings.logger, self.settings.metrics)
                     await asyncio.sleep(10)
                     continue
 
-                for payout in await self.api.load_payouts():
-                    await self.api.claim_payout(payout)
+                try:
+                    await self._fetch_and_claim()
+                except SQLAlchemyError as e:
+                    # Ошибка БД не должна останавливать забор и вместе с ним весь процесс
+                    self.settings.logger.error('fetch_turcode_api DB error:', e)
+                    self.settings.metrics.inc('poll.db_errors')
+                    await asyncio.sleep(1)
+                    continue
 
+                startup.ready(self.settings.logger, self.settings.metrics)
                 await asyncio.sleep(0.005)
         except asyncio.CancelledError:
             print('fetch_turcode_api cancelled')
 
+    async def _fetch_and_claim(self):
+        if self.settings.payouts_streaming:
+            # Каждый кандидат забираем сразу, не дожидаясь остальной страницы
+            async for payout in self.api.stream_payouts():
+                plan, is_reserved = await self.api.reserve_claims(await self.api.plan_claims([payout]))
+                for _payout, bot in plan:
+                    await self.api.claim_payout(_payout, bot, is_reserved)
+        else:
+            payouts = await self.api.load_payouts()
+            plan, is_reserved = await self.api.reserve_claims(await self.api.plan_claims(payouts))
+            for payout, bot in plan:
+                await self.api.claim_payout(payout, bot, is_reserved)
+
+    async def remind_payouts(self):
+        try:
+            await self.api.run_reminders()
+        except asyncio.CancelledError:
+            print('remind_payouts cancelled')
+
+    async def refresh_auth(self):
+        try:
+            await self.api.auth_manager.run()
+        except asyncio.CancelledError:
+            print('refresh_auth cancelled')
+
+    async def ship_journal(self):
+        try:
+            await self.api.journal.run()
+        except asyncio.CancelledError:
+            print('ship_journal cancelled')
+
+    async def listen_config(self):
+        try:
+            await self.db.listen()
+        except asyncio.CancelledError:
+            print('listen_config cancelled')
+
+    async def monitor_loop(self):
+        try:
+            await LoopLagMonitor(self.settings).run()
+        except asyncio.CancelledError:
+            print('monitor_loop cancelled')
+
+    async def monitor_hot_loop(self):
+        try:
+            await LoopLagMonitor(self.settings, 'hot-path').run()
+        except asyncio.CancelledError:
+            print('monitor_hot_loop cancelled')
+
+    async def maintain_partitions(self):
+        try:
+            await PartitionManager(self.settings).run()
+        except asyncio.CancelledError:
+            print('maintain_partitions cancelled')
+
+    async def receive_updates(self):
+        if self.settings.tg_mode == 'webhook':
+            # aiohttp.web и aiogram.webhook нужны только в режиме webhook
+            from code.webhook import WebhookServer
+
+            await WebhookServer(self.settings).run()
+            return
+
+        # Вебхук мог остаться от процесса в режиме webhook, с ним getUpdates не работает
+        await self.settings.bot.delete_webhook()
+        await self.settings.dp.start_polling(self.settings.bot, handle_signals=False)
+
     async def _extra_update_fast(self):
         await self.api.check_claimed_payouts()
         await self.api.update_bot_claimed_payouts_count()
-        await self.db.load_bots()
+        # При живой подписке LISTEN изменения ботов приходят сами
+        if not self.db.is_listening:
+            await self.db.load_bots()
+        self.api.sync_claimed_counts()
 
         # Отправка уведомлений
-        await self.tg.notify_bulk_admins(self.settings.notifications.admins)
-        await self.tg.notify_bulk_watchers(self.settings.notifications.watchers)
-        self.settings.clear_notifications()
+        admins, watchers = self.settings.notifications.drain()
+        await self.tg.notify_bulk_admins(admins)
+        await self.tg.notify_bulk_watchers(watchers)
 
     async def _extra_update_slow(self):
-        await self.db.load_users()
+        # Полная перезагрузка как страховка на случай потерянных уведомлений
+        cur_time = int(time.time())
+        if not self.db.is_listening or cur_time - self.config_last_resync >= self.settings.config_resync_interval:
+            await self.db.load_bots()
+            await self.db.load_users()
+            self.config_last_resync = cur_time
 
     async def extra_update(self):
         try:
@@ -78,12 +168,26 @@ class Runner:
 
     async def start(self):
         # Run both tasks in parallel
-        task1 = asyncio.Task(self.fetch_turcode_api())
-        task2 = asyncio.Task(self.extra_update())
+        hot_path = [self.fetch_turcode_api, self.remind_payouts, self.refresh_auth, self.ship_journal]
+        if self.settings.hot_path_mode == 'thread':
+            # Основной монитор видит только свой loop, зависания claim ловит отдельный
+            hot_path.append(self.monitor_hot_loop)
+            hot_tasks = [asyncio.Task(HotPathThread(self.settings, hot_path).run())]
+        else:
+            hot_tasks = [asyncio.Task(factory()) for factory in hot_path]
+
+        task1 = asyncio.Task(self.extra_update())
+        task2 = asyncio.Task(self.listen_config())
+        task3 = asyncio.Task(self.monitor_loop())
+        task4 = asyncio.Task(self.maintain_partitions())
 
-        polling_task = asyncio.Task(self.settings.dp.start_polling(self.settings.bot, handle_signals=False))
+        polling_task = asyncio.Task(self.receive_updates())
 
-        self.tasks = [task1, task2, polling_task]
+        self.tasks = [*hot_tasks, task1, task2, task3, task4, polling_task]
 
         # Wait for tasks to complete (which won't happen due to infinite loops)
-        await asyncio.gather(*self.tasks)
+        try:
+            await asyncio.gather(*self.tasks)
+        finally:
+            self.settings.tracer.stop()
+            await self.api.webstats.close()
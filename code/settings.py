@@ -1,32 +1,60 @@
+import asyncio
 import copy
 import dataclasses
 import json
 import os
+import threading
+import time
+from contextlib import asynccontextmanager
 
 from aiogram import Bot, Dispatcher
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 
 from code.logger import Logger
+from code.metrics import Metrics
+from code.tracing import Tracer
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class TracedNotification:
+    """Уведомление по платежу: спан notify открывается там, где оно реально отправляется"""
+    text: str
+    trace_id: str
 
 
 @dataclasses.dataclass
 class Notifications:
     admins: list = dataclasses.field(default_factory=list)
     watchers: list = dataclasses.field(default_factory=list)
+    # Уведомления добавляются и из потока горячего пути
+    lock: threading.Lock = dataclasses.field(default_factory=threading.Lock, repr=False, compare=False)
 
     def add_to_admins(self, value):
         """Add a value to the admins list."""
-        self.admins.append(value)
+        with self.lock:
+            self.admins.append(value)
 
     def add_to_watchers(self, value):
         """Add a value to the only_taken list."""
-        self.watchers.append(value)
+        with self.lock:
+            self.watchers.append(value)
 
-    def add_to_all(self, value):
+    def add_to_all(self, value, trace_id: str | None = None):
         """Add a value to both admins and only_taken lists."""
-        self.admins.append(value)
-        self.watchers.append(value)
+        if trace_id is not None:
+            value = TracedNotification(value, trace_id)
+        with self.lock:
+            self.admins.append(value)
+            self.watchers.append(value)
+
+    def drain(self) -> tuple[list, list]:
+        """Забирает накопленные уведомления и очищает списки"""
+        with self.lock:
+            admins, watchers = self.admins, self.watchers
+            self.admins, self.watchers = [], []
+        return admins, watchers
 
 
 class Settings:
@@ -50,16 +78,82 @@ class Settings:
         self.bot_name = bot_name
         self.logger = logger
 
-        self.engine = create_async_engine(
-            '{DB}://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}'.format(
+        # Сдвиг data-end-time относительно UTC на стороне turcode
+        self.end_time_offset = int(os.getenv('TURCODE_END_TIME_OFFSET', 6 * 60 * 60))
+        # Разбирать страницу платежей по мере загрузки
+        self.payouts_streaming = os.getenv('PAYOUTS_STREAMING', '0') == '1'
+        # Разрыв между суммами ботов, начиная с которого опрашиваем окна отдельно, 0 - одним запросом
+        self.payouts_window_gap = int(os.getenv('PAYOUTS_WINDOW_GAP', 0))
+        # После стольких обрезанных опросов подряд окна пролистываются целиком, 0 - никогда
+        self.payouts_sweep_after = int(os.getenv('PAYOUTS_SWEEP_AFTER', 10))
+        # Предел страниц на окно при полном проходе
+        self.payouts_sweep_max_pages = max(1, int(os.getenv('PAYOUTS_SWEEP_MAX_PAGES', 20)))
+        # Интервал полной перезагрузки ботов и пользователей при работающем LISTEN/NOTIFY
+        self.config_resync_interval = int(os.getenv('CONFIG_RESYNC_INTERVAL', 5 * 60))
+        # Через сколько секунд без новых броней слотов под claim оставшиеся брони бота сбрасываются
+        self.claim_reservation_ttl = int(os.getenv('CLAIM_RESERVATION_TTL', 60))
+        # Сколько секунд свои claim по чужому боту считаем еще не учтенными в его кол-ве забранных в БД
+        self.claimed_count_grace = int(os.getenv('CLAIMED_COUNT_GRACE', 20))
+        # Сколько ждем строку забранного платежа в БД, прежде чем отказаться от уведомления о нем
+        self.claimed_notify_max_age = int(os.getenv('CLAIMED_NOTIFY_MAX_AGE', 30 * 60))
+        # Сколько ждем брони слотов в БД, прежде чем забирать по лимитам из памяти
+        self.claim_reserve_timeout = float(os.getenv('CLAIM_RESERVE_TIMEOUT', 0.2))
+        # Пауза перед следующей попыткой брони или возврата слотов после ошибки БД
+        self.claim_reserve_retry_interval = float(os.getenv('CLAIM_RESERVE_RETRY_INTERVAL', 5))
+        # Прием апдейтов Telegram: polling или webhook
+        self.tg_mode = os.getenv('TG_MODE', 'polling')
+        # Где крутится опрос и забор платежей: loop - в общем event loop, thread - в своем потоке
+        self.hot_path_mode = os.getenv('HOT_PATH_MODE', 'loop')
+
+        self.metrics = Metrics()
+        self.tracer = Tracer()
+
+        self.db_url = '{DB}://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}'.format(
+            DB=os.getenv("DB"),
+            DB_USER=os.getenv("DB_USER"),
+            DB_PASS=os.getenv("DB_PASS"),
+            DB_HOST=os.getenv("DB_HOST"),
+            DB_PORT=os.getenv("DB_PORT"),
+            DB_NAME=os.getenv("DB_NAME")
+        )
+        self._local = threading.local()
+
+        # Необязательная реплика только для отчетов, по умолчанию те же настройки, что у основной БД
+        self.db_replica_url = None
+        if os.getenv('DB_REPLICA_HOST'):
+            self.db_replica_url = '{DB}://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}'.format(
                 DB=os.getenv("DB"),
-                DB_USER=os.getenv("DB_USER"),
-                DB_PASS=os.getenv("DB_PASS"),
-                DB_HOST=os.getenv("DB_HOST"),
-                DB_PORT=os.getenv("DB_PORT"),
-                DB_NAME=os.getenv("DB_NAME")
+                DB_USER=os.getenv("DB_REPLICA_USER", os.getenv("DB_USER")),
+                DB_PASS=os.getenv("DB_REPLICA_PASS", os.getenv("DB_PASS")),
+                DB_HOST=os.getenv("DB_REPLICA_HOST"),
+                DB_PORT=os.getenv("DB_REPLICA_PORT", os.getenv("DB_PORT")),
+                DB_NAME=os.getenv("DB_REPLICA_NAME", os.getenv("DB_NAME"))
             )
-        )
+        # Отставание реплики в секундах, после которого читаем с основной БД
+        self.db_replica_max_lag = float(os.getenv('DB_REPLICA_MAX_LAG', 30))
+        self.db_replica_check_interval = float(os.getenv('DB_REPLICA_CHECK_INTERVAL', 10))
+        # Недоступная реплика не должна держать отчеты дольше этого, asyncpg по умолчанию ждет 60 с
+        self.db_replica_timeout = float(os.getenv('DB_REPLICA_TIMEOUT', 2))
+        self._replica_checked_at = 0.0
+        self._replica_is_ok = False
+
+    @property
+    def engine(self):
+        # Соединения asyncpg привязаны к event loop, поэтому у каждого потока свой пул
+        engine = getattr(self._local, 'engine', None)
+        if engine is None:
+            engine = self._local.engine = create_async_engine(self.db_url)
+        return engine
+
+    @property
+    def replica_engine(self):
+        engine = getattr(self._local, 'replica_engine', None)
+        if engine is None:
+            engine = self._local.replica_engine = create_async_engine(
+                self.db_replica_url,
+                connect_args={'timeout': self.db_replica_timeout},
+            )
+        return engine
 
     def __setitem__(self, key, value):
         self.settings[key] = value
@@ -113,9 +207,46 @@ class Settings:
             self.settings = copy.deepcopy(self.default_settings)
             self.logger.error(f"Settings load error: {e}")
 
-    def clear_notifications(self):
-        self.notifications = Notifications()
-
     @property
     def db_session(self):
         return sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def _is_replica_ok(self) -> bool:
+        now_time = time.monotonic()
+        if now_time - self._replica_checked_at < self.db_replica_check_interval:
+            return self._replica_is_ok
+
+        # Результат, в том числе неудачный, кешируется на check_interval - пока реплика лежит,
+        # отчеты сразу идут в основную БД, не дожидаясь таймаута на каждом запросе
+        self._replica_checked_at = now_time
+        try:
+            lag = await asyncio.wait_for(self._get_replica_lag(), self.db_replica_timeout)
+        except Exception as e:
+            self.logger.error(f'DB replica check error: {e!r}')
+            self._replica_is_ok = False
+            return False
+
+        lag = float(lag or 0)
+        self.metrics.set('db.replica_lag_s', lag)
+        self._replica_is_ok = lag <= self.db_replica_max_lag
+        return self._replica_is_ok
+
+    async def _get_replica_lag(self):
+        async with self.replica_engine.connect() as conn:
+            return await conn.scalar(text(
+                'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+                'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'
+            ))
+
+    @asynccontextmanager
+    async def read_session(self):
+        """Сессия для отчетов: реплика, если она есть, жива и не отстала, иначе основная БД"""
+        if self.db_replica_url is not None and await self._is_replica_ok():
+            factory = sessionmaker(self.replica_engine, class_=AsyncSession, expire_on_commit=False)
+        else:
+            if self.db_replica_url is not None:
+                self.metrics.inc('db.replica_fallback')
+            factory = self.db_session
+
+        async with factory() as session:
+            yield session
@@ -0,0 +1,90 @@
+from code.events import EventBus, PayoutEvent, PayoutEventType
+
+
+def extract_payout_id(row: list) -> str:
+    return row[2].split('data-id=')[1].split("'")[1]
+
+
+def extract_end_time(row: list) -> int | None:
+    try:
+        return int(row[4].split('data-end-time=')[1].split("'")[1]) // 1000
+    except (IndexError, ValueError, AttributeError):
+        return None
+
+
+class _Entry:
+    __slots__ = ('is_claimed', 'row')
+
+    def __init__(self, is_claimed: bool, row: list | None = None):
+        self.is_claimed = is_claimed
+        self.row = row
+
+
+class PayoutsSnapshot:
+    """
+    Снимок страницы payouts.php, ключ - id платежа.
+
+    Каждый опрос прогоняется через begin/feed/finish, а наружу уходят только
+    изменения относительно прошлого опроса в виде событий EventBus.
+    """
+    bus: EventBus
+    entries: dict[str, _Entry]
+    claimed_count: int = 0
+    # Сколько раз за все время платежи становились забранными, по разнице считаются новые
+    claimed_total: int = 0
+
+    def __init__(self, bus: EventBus):
+        self.bus = bus
+        self.entries = {}
+        self._seen = set()
+
+    @property
+    def seen(self) -> set[str]:
+        """id платежей, пришедших в текущем или последнем опросе"""
+        return self._seen
+
+    def begin(self):
+        self._seen = set()
+
+    def feed(self, row: list) -> PayoutEvent | None:
+        payout_id = extract_payout_id(row)
+        self._seen.add(payout_id)
+
+        is_claimed = bool(row[3])
+        entry = self.entries.get(payout_id)
+        if entry is not None and entry.is_claimed == is_claimed:
+            return None
+
+        if entry is None:
+            entry = self.entries[payout_id] = _Entry(is_claimed)
+        elif entry.is_claimed:
+            # Платеж вернулся в общий пул
+            self.claimed_count -= 1
+            entry.is_claimed = False
+            entry.row = None
+
+        if not is_claimed:
+            return self.bus.emit(PayoutEvent(PayoutEventType.NEW, payout_id, row))
+
+        entry.is_claimed = True
+        entry.row = row
+        self.claimed_count += 1
+        self.claimed_total += 1
+        return self.bus.emit(PayoutEvent(PayoutEventType.CLAIMED, payout_id, row))
+
+    def finish(self, is_complete: bool = True):
+        # Страница обрезана по длине - отсутствие строки ничего не значит
+        if not is_complete:
+            return
+
+        for payout_id in self.entries.keys() - self._seen:
+            entry = self.entries.pop(payout_id)
+            if entry.is_claimed:
+                self.claimed_count -= 1
+            self.bus.emit(PayoutEvent(PayoutEventType.DISAPPEARED, payout_id, entry.row))
+
+    def discard(self, payout_id: str):
+        """Забываем платеж, чтобы на следующем опросе он снова пришел как новый"""
+        entry = self.entries.get(payout_id)
+        if entry is not None and not entry.is_claimed:
+            del self.entries[payout_id]
@@ -0,0 +1,78 @@
+import os
+import socket
+import time
+from typing import TYPE_CHECKING
+
+# Модуль импортируется первым, до тяжелых зависимостей, чтобы замер старта их учитывал
+if TYPE_CHECKING:
+    import requests as r
+
+
+class Startup:
+    """
+    Замеры старта процесса и сигнал готовности.
+
+    Готовым процесс считается после первого опроса turcode (или первой
+    проверки, что запущенных ботов нет). Тогда в лог пишется отчет по шагам,
+    systemd получает READY=1 через NOTIFY_SOCKET, а если задан READY_FILE,
+    в него пишется время готовности.
+    """
+    started: float
+    steps: list[tuple[str, float]]
+    is_ready: bool = False
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.steps = []
+
+    def mark(self, name: str):
+        self.steps.append((name, time.perf_counter()))
+
+    def report(self) -> str:
+        lines = []
+        prev = self.started
+        for name, at in self.steps:
+            lines.append(f'{name}: {(at - prev) * 1000:.0f} ms')
+            prev = at
+        lines.append(f'total: {(prev - self.started) * 1000:.0f} ms')
+        return '\n'.join(lines)
+
+    def ready(self, logger, metrics):
+        if self.is_ready:
+            return
+        self.is_ready = True
+
+        self.mark('first poll')
+        metrics.set('startup.ready_ms', (self.steps[-1][1] - self.started) * 1000)
+        logger.info(f'Startup timings:\n{self.report()}')
+
+        sd_notify('READY=1')
+        ready_file = os.getenv('READY_FILE')
+        if ready_file:
+            with open(ready_file, 'w') as f:
+                f.write(str(time.time()))
+
+
+def sd_notify(state: str):
+    address = os.getenv('NOTIFY_SOCKET')
+    if not address:
+        return
+
+    # Абстрактный сокет задается с @ в начале
+    if address.startswith('@'):
+        address = '\0' + address[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.sendto(state.encode(), address)
+
+
+def warm_up_session(session: 'r.Session', url: str):
+    """Заранее открывает соединение с turcode, чтобы первый опрос не ждал TCP и TLS"""
+    import requests as r
+
+    try:
+        session.head(url, timeout=5)
+    except r.exceptions.RequestException:
+        pass
+
+
+startup = Startup()
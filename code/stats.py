@@ -12,7 +12,7 @@ async def get_stats(settings, stat_date=None):
         dates = [(today - timedelta(days=i)).strftime('%d.%m.%Y') for i in range(7)]
 
     stats = {}
-    async with settings.db_session() as session:
+    async with settings.read_session() as session:
         for date in dates:
             success_payouts_count = await Payout.get_count_by_date_and_action(
                 session=session,
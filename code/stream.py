@@ -0,0 +1,110 @@
+import json
+import re
+
+_STRING_SPECIAL = re.compile(rb'["\\]')
+_STRUCTURAL = re.compile(rb'["\[\]{},:]')
+
+
+class JSONArrayStream:
+    """
+    Инкрементальный разбор ответа вида {"...": ..., "data": [[...], [...]]}.
+
+    Куски тела подаются в feed по мере получения, наружу сразу отдаются
+    полностью полученные элементы массива по ключу key.
+    """
+    key: bytes
+    found: bool = False
+    finished: bool = False
+
+    def __init__(self, key: str = 'data'):
+        self.key = json.dumps(key).encode()
+        self.buf = bytearray()
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.string_start = 0
+        self.last_string = b''
+        self.expect_array = False
+        self.element_start = None
+
+    def feed(self, chunk: bytes) -> list:
+        self.buf += chunk
+        buf = self.buf
+        pos = self.pos
+        elements = []
+
+        while not self.finished:
+            if self.in_string:
+                match = _STRING_SPECIAL.search(buf, pos)
+                if match is None:
+                    pos = len(buf)
+                    break
+                pos = match.start()
+                if buf[pos] == 0x5C:  # \
+                    if pos + 1 >= len(buf):
+                        break
+                    pos += 2
+                    continue
+                self.in_string = False
+                if self.depth == 1:
+                    self.last_string = bytes(buf[self.string_start:pos + 1])
+                pos += 1
+                continue
+
+            match = _STRUCTURAL.search(buf, pos)
+            if match is None:
+                pos = len(buf)
+                break
+            pos = match.start()
+            char = buf[pos]
+            in_data = self.found and self.depth == 2
+
+            if char == 0x22:  # "
+                self.in_string = True
+                self.string_start = pos
+            elif char == 0x3A:  # :
+                self.expect_array = self.depth == 1 and self.last_string == self.key
+            elif char == 0x5B or char == 0x7B:  # [ {
+                if self.expect_array and self.depth == 1 and char == 0x5B:
+                    self.found = True
+                    self.element_start = pos + 1
+                self.expect_array = False
+                self.depth += 1
+            elif char == 0x5D or char == 0x7D:  # ] }
+                self.depth -= 1
+                if in_data:
+                    self._flush_scalar(buf, pos, elements)
+                    self.finished = True
+                elif self.found and self.depth == 2:
+                    elements.append(json.loads(buf[self.element_start:pos + 1]))
+                    self.element_start = None
+            elif char == 0x2C:  # ,
+                if in_data:
+                    self._flush_scalar(buf, pos, elements)
+                    self.element_start = pos + 1
+                self.expect_array = False
+            pos += 1
+
+        # Отбрасываем уже разобранное начало буфера
+        keep_from = pos
+        if self.element_start is not None:
+            keep_from = min(keep_from, self.element_start)
+        if self.in_string:
+            keep_from = min(keep_from, self.string_start)
+        if keep_from > 0:
+            del buf[:keep_from]
+            pos -= keep_from
+            self.string_start -= keep_from
+            if self.element_start is not None:
+                self.element_start -= keep_from
+        self.pos = pos
+        return elements
+
+    def _flush_scalar(self, buf: bytearray, pos: int, elements: list):
+        # Скалярные элементы массива (числа, строки, null) заканчиваются на , или ]
+        if self.element_start is None:
+            return
+        value = bytes(buf[self.element_start:pos]).strip()
+        self.element_start = None
+        if value:
+            elements.append(json.loads(value))
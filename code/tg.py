@@ -1,20 +1,22 @@
+import asyncio
 import os
+import tempfile
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from aiogram import Bot as TgBot
 from aiogram import Dispatcher, types, Router, F
 from aiogram.filters import Command
 from aiogram.filters.callback_data import CallbackData
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile, FSInputFile
 from dotenv import load_dotenv
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
+from code.banks import parse_banks
 from code.db import DB
 from code.models import Payout, PayoutActionEnum, User, Bot
-from code.settings import Settings
-from code.stats import get_stats
+from code.settings import Settings, TracedNotification
 
 load_dotenv()
 
@@ -39,31 +41,29 @@ class BotCallback(CallbackData, prefix='bot'):
 class Tg:
     api: None
     routers: Routers
+    loop: asyncio.AbstractEventLoop | None = None
 
     def __init__(self, session: Session, settings: Settings, db: DB):
         self.session = session
         self.settings = settings
         self.db = db
+        self.memory_tracker = None
+        self.is_profiling = False
 
     def _is_user_exists(self, chat: types.Chat) -> bool:
         if not (self.db and self.db.cur_bot):
             return False
 
-        for user in self.db.cur_bot.users:
-            if user.chat_id == str(chat.id):
-                return True
-        return False
+        return str(chat.id) in self.db.cur_bot.user_chat_ids
 
     def _is_admin(self, chat: types.Chat) -> bool:
         if not (self.db and self.db.cur_bot):
             return False
 
-        for user in self.db.cur_bot.users:
-            if user.chat_id == str(chat.id) and user.is_admin:
-                return True
-        return False
+        return str(chat.id) in self.db.cur_bot.admin_chat_ids
 
     def setup(self):
+        self.loop = asyncio.get_running_loop()
         self.settings.bot = TgBot(token=self.db.cur_bot.tg_bot_token)
         self.settings.dp = Dispatcher()
 
@@ -91,12 +91,18 @@ class Tg:
         self.routers.base.message.register(self._status_command, Command('status'))
         self.routers.base.message.register(self._stats_command, Command('stats'))
 
-        # self.routers.admin.message.register(self._webstats_command, Command('webstats'))
+        self.routers.admin.message.register(self._webstats_command, Command('webstats'))
         self.routers.base.message.register(self._payout_command, Command('payout'))
         self.routers.base.message.register(self._set_min_amount_command, Command('set_min_amount'))
         self.routers.base.message.register(self._set_max_amount_command, Command('set_max_amount'))
         self.routers.base.message.register(self._set_payouts_limit_command, Command('set_payouts_limit'))
 
+        self.routers.admin.message.register(self._set_banks_command, Command('set_banks'))
+        self.routers.admin.message.register(self._metrics_command, Command('metrics'))
+        self.routers.admin.message.register(self._profile_command, Command('profile'))
+        self.routers.admin.message.register(self._tracemalloc_command, Command('tracemalloc'))
+        self.routers.admin.message.register(self._race_stats_command, Command('race_stats'))
+        self.routers.admin.message.register(self._export_command, Command('export'))
         self.routers.admin.message.register(self._add_user_command, Command('add_user'))
         self.routers.admin.message.register(self._list_bots, Command('bots_users'))
 
@@ -117,9 +123,16 @@ class Tg:
     async def send_msg(self, chat_id: int, text: str):
         await self.settings.bot.send_message(chat_id, text)
 
+    def _is_foreign_loop(self) -> bool:
+        return self.loop is not None and asyncio.get_running_loop() is not self.loop
+
     async def notify_admins(self, *args):
         if not (self.db and self.db.cur_bot):
             return
+        if self._is_foreign_loop():
+            # Из потока горячего пути отправка уходит в loop бота, вызывающий ее не ждет
+            asyncio.run_coroutine_threadsafe(self.notify_admins(*args), self.loop)
+            return
 
         text = ' '.join([str(s) for s in args])
         for admin in self.db.cur_bot.users:
@@ -131,6 +144,10 @@ class Tg:
     async def notify_watchers(self, *args):
         if not (self.db and self.db.cur_bot):
             return
+        if self._is_foreign_loop():
+            # Из потока горячего пути отправка уходит в loop бота, вызывающий ее не ждет
+            asyncio.run_coroutine_threadsafe(self.notify_watchers(*args), self.loop)
+            return
 
         text = ' '.join([str(s) for s in args])
         for watcher in self.db.cur_bot.users:
@@ -141,12 +158,20 @@ class Tg:
 
     async def notify_bulk_admins(self, notifications):
         for notification in notifications:
+            if isinstance(notification, TracedNotification):
+                with self.settings.tracer.span('notify', notification.trace_id, to='admins'):
+                    await self.notify_admins(notification.text)
+                continue
             if isinstance(notification, str):
                 notification = [notification]
             await self.notify_admins(*notification)
 
     async def notify_bulk_watchers(self, notifications):
         for notification in notifications:
+            if isinstance(notification, TracedNotification):
+                with self.settings.tracer.span('notify', notification.trace_id, to='watchers'):
+                    await self.notify_watchers(notification.text)
+                continue
             if isinstance(notification, str):
                 notification = [notification]
             await self.notify_watchers(*notification)
@@ -162,7 +187,12 @@ class Tg:
             + f'{'Статистика':=^20}' + '\n' +
             '/webstats - получить статистику с turcode\n'
             '/stats - получить статистику\n'
-            '/payout <operation_id> - найти платеж среди всех платежей забранных всеми ботами\n\n'
+            '/metrics - метрики опроса и забора платежей\n'
+            '/profile <seconds> - профиль процесса за указанное кол-во секунд\n'
+            '/tracemalloc - прирост памяти с прошлого вызова, /tracemalloc stop - выключить\n'
+            '/race_stats <days> - задержки забора платежей за последние дни, по умолчанию за сутки\n'
+            '/payout <operation_id> - найти платеж среди всех платежей забранных всеми ботами\n'
+            '/export <from> <to> [csv|parquet] - выгрузить платежи всех ботов за период, даты в формате дд.мм.гггг\n\n'
             + f'{'Настройки':=^20}' + '\n' +
             '/set_min_amount <number> - установить минимальную сумму резервирования платежа, '
             '<number> - любое целое число, можно использовать пробел как разделитель\n'
@@ -170,21 +200,19 @@ class Tg:
             '<number> - любое целое число, можно использовать пробел как разделитель\n'
             '/set_payouts_limit <number> - установить лимит кол-ва платежей, '
             '<number> - любое целое число, можно использовать пробел как разделитель\n'
+            '/set_banks <bank>, <bank> - установить список банков через запятую, '
+            '/set_banks default - вернуть список по умолчанию\n'
             '/add_user <name> <chat_id> - добавить нового пользователя\n'
             '/bots_users - управление пользователями ботов\n',
         )
 
     async def _run_command(self, message: types.Message):
-        async with self.settings.db_session() as session:
-            await self.db.cur_bot.set_is_running(session, True)
-            await session.commit()
+        self.db.set_bot_values(self.db.cur_bot.id, is_running=True)
 
         await message.answer('Запустил штуку')
 
     async def _stop_command(self, message: types.Message):
-        async with self.settings.db_session() as session:
-            await self.db.cur_bot.set_is_running(session, False)
-            await session.commit()
+        self.db.set_bot_values(self.db.cur_bot.id, is_running=False)
 
         await message.answer('Остановил штуку')
 
@@ -193,7 +221,8 @@ class Tg:
             f'Штука запущена: {'да' if self.db.cur_bot.is_running else 'нет'}\n'
             f'Мин. сумма резервирования: {self.format_number(self.db.cur_bot.min_amount)}\n'
             f'Макс. сумма резервирования: {self.format_number(self.db.cur_bot.max_amount)}\n'
-            f'Лимит кол-ва платежей: {self.format_number(self.db.cur_bot.claimed_payouts_limit)}'
+            f'Лимит кол-ва платежей: {self.format_number(self.db.cur_bot.claimed_payouts_limit)}\n'
+            f'Банки: {', '.join(parse_banks(self.db.cur_bot.allowed_banks)) or '-'}'
         )
 
     async def _webstats_command(self, message: types.Message):
@@ -201,8 +230,7 @@ class Tg:
             await message.answer('Апи не подключено')
             return
 
-        # TODO: переписать без использования апи
-        for k, profiles in enumerate(self.api.get_stats()):
+        for k, profiles in enumerate(await self.api.webstats.get()):
             stats_msg = ''
             k_msg = f' Бот {k + 1} '
             stats_msg += f'{k_msg:=^20}' + '\n'
@@ -220,6 +248,112 @@ class Tg:
                                       f'Кол-во платежей за 24 часа: {stat['payouts_count_for_24h']}\n\n\n')
             await message.answer(stats_msg)
 
+    async def _metrics_command(self, message: types.Message):
+        await message.answer(self.settings.metrics.report() or 'Метрик пока нет')
+
+    async def _profile_command(self, message: types.Message):
+        seconds = message.text.replace('/profile', '').strip() or '10'
+        try:
+            seconds = float(seconds)
+        except ValueError:
+            await message.answer('Неверный формат ввода, пример: /profile 30')
+            return
+
+        if not 0 < seconds <= 300:
+            await message.answer('Профилировать можно от 1 до 300 секунд')
+            return
+        if self.is_profiling:
+            await message.answer('Профилирование уже идет')
+            return
+
+        self.is_profiling = True
+        try:
+            await message.answer(f'Профилирую {seconds:g} сек.')
+            from code.profiler import SamplingProfiler
+
+            profiler = SamplingProfiler()
+            await profiler.profile(seconds)
+        finally:
+            self.is_profiling = False
+
+        await message.answer(profiler.summary()[:4000])
+        await message.answer_document(BufferedInputFile(
+            profiler.collapsed().encode(),
+            filename=f'profile-{datetime.now().strftime("%Y%m%d-%H%M%S")}.collapsed',
+        ))
+
+    async def _tracemalloc_command(self, message: types.Message):
+        from code.profiler import MemoryTracker
+
+        if self.memory_tracker is None:
+            self.memory_tracker = MemoryTracker()
+
+        if message.text.replace('/tracemalloc', '').strip() == 'stop':
+            self.memory_tracker.stop()
+            await message.answer('tracemalloc выключен')
+            return
+
+        await message.answer(self.memory_tracker.diff()[:4000])
+
+    async def _race_stats_command(self, message: types.Message):
+        days = message.text.replace('/race_stats', '').strip() or '1'
+        try:
+            days = int(days)
+        except ValueError:
+            await message.answer('Неверный формат ввода, пример: /race_stats 7')
+            return
+
+        async with self.settings.read_session() as session:
+            stats = await Payout.get_race_stats(session, self.settings.bot_name, datetime.now() - timedelta(days=days))
+
+        if not stats:
+            await message.answer('Данных по таймингам пока нет')
+            return
+
+        names = {
+            'route': 'Опрос попытки → claim',
+            'claim': 'Claim → ответ',
+            'total': 'Появление → ответ',
+        }
+        for action, action_stats in stats.items():
+            action_text = (PayoutActionEnum.SUCCESS.text
+                           if action == PayoutActionEnum.SUCCESS.code else
+                           PayoutActionEnum.FAIL.text)
+            msg = f'{action_text}\nКол-во: {action_stats['count']}\n\np50 / p90 / p99, мс\n'
+            for name, title in names.items():
+                msg += f'{title}: {' / '.join(f'{value:.0f}' for value in action_stats[name])}\n'
+            await message.answer(msg)
+
+    async def _export_command(self, message: types.Message):
+        from code.export import EXPORT_FORMATS, export_payouts, parse_date
+
+        args = message.text.replace('/export', '').strip().split()
+        fmt = args.pop() if len(args) == 3 else 'csv'
+        try:
+            date_from, date_to = map(parse_date, args)
+        except ValueError:
+            await message.answer('Неверный формат ввода, пример: /export 01.10.2024 31.10.2024 csv')
+            return
+
+        if fmt not in EXPORT_FORMATS:
+            await message.answer(f'Формат выгрузки: {', '.join(EXPORT_FORMATS)}')
+            return
+
+        filename = f'payouts-{date_from:%Y%m%d}-{date_to:%Y%m%d}.{fmt}'
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, filename)
+            try:
+                rows_count = await export_payouts(self.settings, path, date_from, date_to, fmt)
+            except ValueError as e:
+                await message.answer(str(e))
+                return
+
+            if not rows_count:
+                await message.answer('Платежей за период нет')
+                return
+
+            await message.answer_document(FSInputFile(path, filename=filename), caption=f'Строк: {rows_count}')
+
     async def _stats_command(self, message: types.Message):
         stats_date = message.text.replace('/stats', '').strip() or None
 
@@ -230,6 +364,8 @@ class Tg:
                 await message.answer('Неверный формат даты')
                 return
 
+        from code.stats import get_stats
+
         stats_dict = await get_stats(self.settings, stats_date)
         for date, metrics in stats_dict.items():
             await message.answer(
@@ -256,7 +392,7 @@ class Tg:
                 'пример: /payout W153944573'
             )
 
-        async with self.settings.db_session() as session:
+        async with self.settings.read_session() as session:
             payouts = await Payout.search_payouts(session, search_value)
 
             if payouts:
@@ -290,9 +426,7 @@ class Tg:
                 'Неверный формат ввода, пример: /set_min_amount 50 000'
             )
         else:
-            async with self.settings.db_session() as session:
-                await self.db.cur_bot.set_min_amount(session, new_min_amount)
-                await session.commit()
+            self.db.set_bot_values(self.db.cur_bot.id, min_amount=new_min_amount)
 
             await message.answer(
                 f'Мин. сумма резервирования: {self.format_number(new_min_amount)}'
@@ -305,9 +439,7 @@ class Tg:
         except ValueError:
             await message.answer('Неверный формат ввода, пример: /set_max_amount 80 000')
         else:
-            async with self.settings.db_session() as session:
-                await self.db.cur_bot.set_max_amount(session, new_max_amount)
-                await session.commit()
+            self.db.set_bot_values(self.db.cur_bot.id, max_amount=new_max_amount)
 
             await message.answer(f'Макс. сумма резервирования: {self.format_number(new_max_amount)}')
 
@@ -319,12 +451,21 @@ class Tg:
         except ValueError:
             await message.answer('Неверный формат ввода, пример: /set_payouts_limit 10')
         else:
-            async with self.settings.db_session() as session:
-                await self.db.cur_bot.set_claimed_payouts_limit(session, new_payouts_limits)
-                await session.commit()
+            self.db.set_bot_values(self.db.cur_bot.id, claimed_payouts_limit=new_payouts_limits)
 
             await message.answer(f'Лимит кол-ва платежей: {self.format_number(new_payouts_limits)}')
 
+    async def _set_banks_command(self, message: types.Message):
+        value = message.text.replace('/set_banks', '').strip()
+        if not value:
+            await message.answer('Неверный формат ввода, пример: /set_banks Тинькофф, Сбербанк')
+            return
+
+        allowed_banks = None if value == 'default' else ', '.join(parse_banks(value))
+        self.db.set_bot_values(self.db.cur_bot.id, allowed_banks=allowed_banks)
+
+        await message.answer(f'Банки: {', '.join(parse_banks(allowed_banks))}')
+
     async def _add_user_command(self, message: types.Message):
         data = message.text.replace('/add_user', '').strip().split()
 
@@ -359,7 +500,7 @@ class Tg:
         await method("Список ботов", reply_markup=markup)
 
     async def _show_users_in_bot(self, callback_query: types.CallbackQuery, callback_data: BotCallback = None,
-                                 bot_id: int = None, page: int = None):
+                                 bot_id: int = None, page: int = None, is_fresh: bool = False):
         page_size = 10
 
         if bot_id is None:
@@ -367,16 +508,18 @@ class Tg:
         if page is None:
             page = callback_data.page
 
-        async with self.settings.db_session() as session:
-            all_users = await User.get_all(session)
-            bot_users = await User.get_by_bot_id(session, bot_id)
+        # Сразу после изменения читаем с основной БД, реплика могла еще не догнать
+        read_session = self.settings.db_session if is_fresh else self.settings.read_session
+        async with read_session() as session:
+            users_count = await User.get_count(session)
+            cur_page_users = await User.get_page(session, (page - 1) * page_size, page_size)
+            bot_user_ids = await User.get_ids_in_bot(session, bot_id, [user.id for user in cur_page_users])
 
-        has_next = len(all_users) >= page * page_size
-        cur_page_users = all_users[(page - 1) * page_size: page * page_size]
+        has_next = users_count > page * page_size
 
         users_btns = []
         for user in cur_page_users:
-            is_added_to_bot = user in bot_users
+            is_added_to_bot = user.id in bot_user_ids
             users_btns.append(InlineKeyboardButton(
                 text=f'{'🟩' if is_added_to_bot else '🟥'} {user.name}',
                 callback_data=UserCallback(bot_id=bot_id, user_id=user.id, page=page).pack()
@@ -412,17 +555,10 @@ class Tg:
         page = callback_data.page
 
         async with self.settings.db_session() as session:
-            bot = await Bot.get_by_id(session, bot_id)
-            user = await User.get_by_id(session, user_id)
-
-            if user in bot.users:
-                await bot.remove_user(session, user)
-            else:
-                await bot.add_user(session, user)
-
+            await Bot.toggle_user(session, bot_id, user_id)
             await session.commit()
 
-        await self.db.load_bots()
-        await self.db.load_users()
+        # Поменялись только связи одного бота
+        await self.db.reload_bot(bot_id)
 
-        return await self._show_users_in_bot(callback_query, bot_id=bot_id, page=page)
+        return await self._show_users_in_bot(callback_query, bot_id=bot_id, page=page, is_fresh=True)
@@ -0,0 +1,172 @@
+import json
+import logging
+import os
+import queue
+import random
+import secrets
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+
+class Span:
+    """Отрезок работы над платежом, закрывается через with или end()"""
+    __slots__ = ('tracer', 'trace_id', 'span_id', 'parent_id', 'name', 'start', 'end_time', 'attrs', 'native')
+
+    def __init__(self, tracer: 'Tracer', trace_id: str, name: str, parent: 'Span | None', attrs: dict):
+        self.tracer = tracer
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.name = name
+        self.start = time.time_ns()
+        self.end_time = None
+        self.attrs = attrs
+        self.native = None
+
+    def set(self, key: str, value):
+        self.attrs[key] = value
+
+    def end(self):
+        if self.end_time is None:
+            self.end_time = time.time_ns()
+            self.tracer.exporter.end(self)
+
+    def to_dict(self) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration_us': (self.end_time - self.start) // 1000,
+            'attrs': self.attrs,
+        }
+
+    def __enter__(self) -> 'Span':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs['error'] = repr(exc)
+        self.end()
+
+
+class _NoopSpan:
+    """Заглушка для несемплированных трейсов, ничего не стоит на горячем пути"""
+
+    def set(self, key: str, value):
+        pass
+
+    def end(self):
+        pass
+
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class FileExporter:
+    """JSONL с ротацией, запись идет в отдельном потоке через очередь"""
+
+    def __init__(self, path: str, max_bytes: int, backup_count: int):
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+
+        self.queue = queue.SimpleQueue()
+        self.listener = QueueListener(self.queue, handler)
+        self.listener.start()
+
+        self.logger = logging.getLogger('code.tracing')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(QueueHandler(self.queue))
+
+    def start(self, span: Span):
+        pass
+
+    def end(self, span: Span):
+        self.logger.info(json.dumps(span.to_dict(), ensure_ascii=False, default=str))
+
+    def stop(self):
+        self.listener.stop()
+
+
+class OTelExporter:
+    """Прокидывает спаны в OpenTelemetry, экспорт настраивается стандартными OTEL_* переменными"""
+
+    def __init__(self):
+        self.tracer = otel_trace.get_tracer('turcode')
+        self.parents: dict[str, object] = {}
+
+    def start(self, span: Span):
+        parent = self.parents.get(span.parent_id)
+        context = otel_trace.set_span_in_context(parent) if parent is not None else None
+        span.native = self.tracer.start_span(span.name, context=context, start_time=span.start)
+        span.native.set_attribute('payout.trace_id', span.trace_id)
+        self.parents[span.span_id] = span.native
+
+    def end(self, span: Span):
+        for key, value in span.attrs.items():
+            span.native.set_attribute(key, str(value))
+        span.native.end(end_time=span.end_time)
+        self.parents.pop(span.span_id, None)
+
+    def stop(self):
+        pass
+
+
+class Tracer:
+    """
+    Легкие трейсы по платежам.
+
+    На каждый кандидат заводится trace_id, дальше он едет вместе с платежом
+    через маршрутизацию, claim, запись в БД и уведомление. Семплирование
+    решается один раз на трейс: для несемплированных span() возвращает
+    заглушку без аллокаций.
+    """
+    sample_rate: float
+
+    def __init__(self):
+        self.sample_rate = float(os.getenv('TRACE_SAMPLE_RATE', 0))
+        self.exporter = None
+
+        exporter = os.getenv('TRACE_EXPORTER', 'file')
+        if self.sample_rate <= 0:
+            return
+
+        if exporter == 'otel' and otel_trace is not None:
+            self.exporter = OTelExporter()
+        else:
+            self.exporter = FileExporter(
+                os.getenv('TRACE_FILE', 'traces.jsonl'),
+                int(os.getenv('TRACE_FILE_MAX_BYTES', 10 * 1024 * 1024)),
+                int(os.getenv('TRACE_FILE_BACKUP_COUNT', 3)),
+            )
+
+    def new_trace(self) -> str | None:
+        """Новый trace_id или None, если трейс не попал в выборку"""
+        if self.exporter is None or random.random() >= self.sample_rate:
+            return None
+        return secrets.token_hex(16)
+
+    def span(self, name: str, trace_id: str | None, parent: Span | None = None, **attrs) -> Span | _NoopSpan:
+        if trace_id is None:
+            return NOOP_SPAN
+
+        span = Span(self, trace_id, name, parent, attrs)
+        self.exporter.start(span)
+        return span
+
+    def stop(self):
+        if self.exporter is not None:
+            self.exporter.stop()
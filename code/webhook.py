@@ -0,0 +1,101 @@
+import argparse
+import asyncio
+import json
+import os
+import secrets
+import time
+
+from aiohttp import web, ClientSession
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from code.settings import Settings
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """
+    Прием апдейтов Telegram через вебхук вместо long polling.
+
+    Локальный aiohttp сервер принимает апдейты только с верным секретным токеном
+    и отдает их в Dispatcher. При старте вебхук ставится на TG_WEBHOOK_URL, при
+    остановке снимается, так что апдейты, пришедшие во время рестарта, дождутся
+    следующего процесса на стороне Telegram, а переключение обратно на polling
+    ничего не теряет.
+    """
+    settings: Settings
+
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self.host = os.getenv('TG_WEBHOOK_HOST', '127.0.0.1')
+        self.port = int(os.getenv('TG_WEBHOOK_PORT', 8443))
+        self.path = os.getenv('TG_WEBHOOK_PATH', '/tg/webhook')
+        self.url = os.getenv('TG_WEBHOOK_URL')
+        self.secret = os.getenv('TG_WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+
+        if not self.url:
+            raise ValueError('TG_WEBHOOK_URL is required in webhook mode')
+
+    async def run(self):
+        bot, dp = self.settings.bot, self.settings.dp
+
+        app = web.Application()
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=self.secret).register(app, path=self.path)
+        setup_application(app, dp, bot=bot)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.host, self.port).start()
+            await bot.set_webhook(
+                f'{self.url.rstrip('/')}{self.path}',
+                secret_token=self.secret,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+            self.settings.logger.info(f'Webhook listening on {self.host}:{self.port}{self.path}')
+
+            await asyncio.Event().wait()
+        finally:
+            try:
+                await bot.delete_webhook()
+            finally:
+                await runner.cleanup()
+
+
+async def post_fake_update(url: str, secret: str, chat_id: int, text: str) -> int:
+    """Шлет на локальный вебхук апдейт с сообщением, как будто его прислал Telegram"""
+    update = {
+        'update_id': int(time.time()),
+        'message': {
+            'message_id': 1,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'fake'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+            if text.startswith('/') else [],
+        },
+    }
+    async with ClientSession() as session:
+        async with session.post(url, data=json.dumps(update), headers={
+            SECRET_HEADER: secret,
+            'Content-Type': 'application/json',
+        }) as response:
+            return response.status
+
+
+async def main():
+    # Проверка вебхука локально: python -m code.webhook <chat_id> "/status"
+    parser = argparse.ArgumentParser(description='Отправка фейкового апдейта на локальный вебхук')
+    parser.add_argument('chat_id', type=int)
+    parser.add_argument('text')
+    parser.add_argument('--url', default=f'http://127.0.0.1:{os.getenv('TG_WEBHOOK_PORT', 8443)}'
+                                         f'{os.getenv('TG_WEBHOOK_PATH', '/tg/webhook')}')
+    parser.add_argument('--secret', default=os.getenv('TG_WEBHOOK_SECRET', ''))
+    args = parser.parse_args()
+
+    print(await post_fake_update(args.url, args.secret, args.chat_id, args.text))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
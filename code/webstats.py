@@ -0,0 +1,76 @@
+import asyncio
+import os
+import time
+from typing import TYPE_CHECKING
+
+import aiohttp
+import requests as r
+
+if TYPE_CHECKING:
+    from code.api import API
+
+
+class WebStats:
+    """
+    Статистика аккаунтов turcode со всех хостов.
+
+    Свой аккаунт и хосты из WEBAPP_LIST опрашиваются параллельно, каждый со
+    своим таймаутом; не успевший хост дает None, остальные результаты
+    возвращаются как есть. Результат кешируется на ttl секунд, одновременные
+    запросы склеиваются в один.
+    """
+    api: 'API'
+    hosts: list[tuple[str, str]]
+
+    def __init__(self, api: 'API'):
+        self.api = api
+        self.timeout = float(os.getenv('WEBSTATS_TIMEOUT', 5))
+        self.ttl = float(os.getenv('WEBSTATS_CACHE_TTL', 60))
+
+        webapp_list = os.getenv('WEBAPP_LIST', default='')
+        self.hosts = [tuple(item.split('::', 1)) for item in webapp_list.split(';') if '::' in item]
+
+        self._cache: list | None = None
+        self._cache_time = 0.0
+        self._inflight: asyncio.Task | None = None
+        self._session: aiohttp.ClientSession | None = None
+        # Свой аккаунт опрашиваем из рабочего потока, поэтому не трогаем сессию горячего пути
+        self._local_session = r.Session()
+
+    async def get(self) -> list[list[dict] | None]:
+        if self._cache is not None and time.monotonic() - self._cache_time < self.ttl:
+            return self._cache
+
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.create_task(self._collect())
+        return await asyncio.shield(self._inflight)
+
+    async def _collect(self) -> list[list[dict] | None]:
+        result = await asyncio.gather(self._fetch_local(), *(self._fetch_host(host, password) for host, password in self.hosts))
+        self._cache = list(result)
+        self._cache_time = time.monotonic()
+        return self._cache
+
+    async def _fetch_local(self) -> list[dict] | None:
+        try:
+            return await asyncio.wait_for(asyncio.to_thread(self.api.get_webstats, self._local_session, self.timeout), self.timeout)
+        except asyncio.TimeoutError:
+            self.api.logger.error('Webstats timeout: turcode')
+            return None
+
+    async def _fetch_host(self, host: str, password: str) -> list[dict] | None:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+        try:
+            async with self._session.get(f'{host}/webstats', headers={'Authorization': f'Bearer {password}'}) as response:
+                response.raise_for_status()
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            self.api.logger.error(f'Ping {host} error method webstats: {e!r}')
+            return None
+
+    async def close(self):
+        self._local_session.close()
+        if self._session is not None:
+            await self._session.close()
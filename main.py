@@ -1,3 +1,6 @@
+# Часы старта запускаются при импорте code.startup, поэтому он идет до всех тяжелых импортов
+from code.startup import startup, warm_up_session
+
 import asyncio
 import os
 import signal
@@ -20,6 +23,7 @@ def handle_sigint():
 
 
 async def main():
+    startup.mark('imports')
     sys.stdout.reconfigure(encoding='utf-8')
     logger = Logger()
     logger.info('Starting app')
@@ -29,15 +33,22 @@ async def main():
     settings.load()
 
     db = DB(settings)
-    await db.load_bots()
-    await db.load_users()
+    session = r.Session()
+    startup.mark('settings')
+
+    # Боты, пользователи и соединение с turcode друг от друга не зависят
+    await asyncio.gather(
+        db.load_bots(),
+        db.load_users(),
+        asyncio.to_thread(warm_up_session, session, API.base_url),
+    )
+    startup.mark('load bots and users')
 
     # Base.metadata.create_all(settings.engine)
 
     logger.info('Settings:', settings)
 
     # Приступаем к запуску
-    session = r.Session()
     session.cookies.set('auth', db.cur_bot.auth_cookie)
 
     tg = Tg(session, settings, db)
@@ -46,6 +57,7 @@ async def main():
 
     runner = Runner(settings, db, api, tg)
     tg.setup()
+    startup.mark('setup')
 
     await runner.start()
 
@@ -0,0 +1,54 @@
+"""Filter config change notify triggers
+
+Revision ID: b8c6d0e2f4a7
+Revises: a7b5c9d1e3f6
+Create Date: 2024-10-17 11:24:05.318274
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'b8c6d0e2f4a7'
+down_revision = 'a7b5c9d1e3f6'
+branch_labels = None
+depends_on = None
+
+TABLES = ['bots', 'users', 'user_bot_association']
+
+# Счетчик забранных и куки пишутся постоянно и к настройкам бота не относятся
+BOTS_IGNORED_COLUMNS = ['claimed_payouts_count', 'auth_cookie']
+
+
+def _update_condition(table: str) -> str:
+    if table != 'bots':
+        return 'OLD.* IS DISTINCT FROM NEW.*'
+
+    ignored = ' - '.join(f"'{column}'" for column in BOTS_IGNORED_COLUMNS)
+    return f'to_jsonb(OLD) - {ignored} IS DISTINCT FROM to_jsonb(NEW) - {ignored}'
+
+
+def upgrade():
+    for table in TABLES:
+        op.execute(f'DROP TRIGGER IF EXISTS {table}_notify_config_change ON {table};')
+        op.execute(f"""
+            CREATE TRIGGER {table}_notify_config_change
+            AFTER INSERT OR DELETE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION notify_config_change();
+        """)
+        op.execute(f"""
+            CREATE TRIGGER {table}_notify_config_update
+            AFTER UPDATE ON {table}
+            FOR EACH ROW WHEN ({_update_condition(table)})
+            EXECUTE FUNCTION notify_config_change();
+        """)
+
+
+def downgrade():
+    for table in TABLES:
+        op.execute(f'DROP TRIGGER IF EXISTS {table}_notify_config_update ON {table};')
+        op.execute(f'DROP TRIGGER IF EXISTS {table}_notify_config_change ON {table};')
+        op.execute(f"""
+            CREATE TRIGGER {table}_notify_config_change
+            AFTER INSERT OR UPDATE OR DELETE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION notify_config_change();
+        """)
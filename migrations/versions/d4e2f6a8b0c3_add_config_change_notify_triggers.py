@@ -0,0 +1,56 @@
+"""Add config change notify triggers
+
+Revision ID: d4e2f6a8b0c3
+Revises: c3d1e5f7a9b2
+Create Date: 2024-10-05 18:31:47.201936
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'd4e2f6a8b0c3'
+down_revision = 'c3d1e5f7a9b2'
+branch_labels = None
+depends_on = None
+
+TABLES = ['bots', 'users', 'user_bot_association']
+
+
+def upgrade():
+    op.execute("""
+        CREATE OR REPLACE FUNCTION notify_config_change() RETURNS trigger AS $$
+        DECLARE
+            changed RECORD;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                changed := OLD;
+            ELSE
+                changed := NEW;
+            END IF;
+
+            IF TG_TABLE_NAME = 'user_bot_association' THEN
+                PERFORM pg_notify('config_changes', json_build_object(
+                    'table', TG_TABLE_NAME, 'id', changed.bot_id, 'user_id', changed.user_id
+                )::text);
+            ELSE
+                PERFORM pg_notify('config_changes', json_build_object(
+                    'table', TG_TABLE_NAME, 'id', changed.id
+                )::text);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+
+    for table in TABLES:
+        op.execute(f"""
+            CREATE TRIGGER {table}_notify_config_change
+            AFTER INSERT OR UPDATE OR DELETE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION notify_config_change();
+        """)
+
+
+def downgrade():
+    for table in TABLES:
+        op.execute(f'DROP TRIGGER IF EXISTS {table}_notify_config_change ON {table};')
+    op.execute('DROP FUNCTION IF EXISTS notify_config_change();')
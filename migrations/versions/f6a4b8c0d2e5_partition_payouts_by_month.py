@@ -0,0 +1,72 @@
+"""Partition payouts by month
+
+Revision ID: f6a4b8c0d2e5
+Revises: e5f3a7b9c1d4
+Create Date: 2024-10-12 11:07:54.318290
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'f6a4b8c0d2e5'
+down_revision = 'e5f3a7b9c1d4'
+branch_labels = None
+depends_on = None
+
+INDEXES = {
+    'ix_payouts_bot_name_created_at': '(bot_name, created_at)',
+    'ix_payouts_operation_id': '(operation_id)',
+    'ix_payouts_card': '(card)',
+    'ix_payouts_phone': '(phone)',
+}
+
+
+def upgrade():
+    op.execute('UPDATE payouts SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL')
+    op.execute('ALTER TABLE payouts RENAME TO payouts_legacy')
+    op.execute('ALTER TABLE payouts_legacy RENAME CONSTRAINT payouts_pkey TO payouts_legacy_pkey')
+
+    op.execute("""
+        CREATE TABLE payouts (LIKE payouts_legacy INCLUDING DEFAULTS)
+        PARTITION BY RANGE (created_at)
+    """)
+    op.execute('ALTER TABLE payouts ALTER COLUMN created_at SET NOT NULL')
+    op.execute('ALTER TABLE payouts ADD CONSTRAINT payouts_pkey PRIMARY KEY (id, created_at)')
+    op.execute('ALTER SEQUENCE payouts_id_seq OWNED BY payouts.id')
+
+    # Месячные партиции от самого старого платежа до двух месяцев вперед,
+    # дальше их заводит code/partitions.py
+    op.execute("""
+        DO $$
+        DECLARE
+            month date := date_trunc('month', COALESCE(
+                (SELECT min(created_at) FROM payouts_legacy), CURRENT_TIMESTAMP
+            ))::date;
+        BEGIN
+            WHILE month <= date_trunc('month', CURRENT_TIMESTAMP + interval '2 months') LOOP
+                EXECUTE format(
+                    'CREATE TABLE payouts_p%s PARTITION OF payouts FOR VALUES FROM (%L) TO (%L)',
+                    to_char(month, 'YYYYMM'), month, (month + interval '1 month')::date
+                );
+                month := (month + interval '1 month')::date;
+            END LOOP;
+        END $$;
+    """)
+    op.execute('CREATE TABLE payouts_default PARTITION OF payouts DEFAULT')
+
+    for name, columns in INDEXES.items():
+        op.execute(f'CREATE INDEX {name} ON payouts {columns}')
+
+    op.execute('INSERT INTO payouts SELECT * FROM payouts_legacy')
+    op.execute('DROP TABLE payouts_legacy')
+
+
+def downgrade():
+    op.execute('ALTER TABLE payouts RENAME TO payouts_partitioned')
+    op.execute('CREATE TABLE payouts (LIKE payouts_partitioned INCLUDING DEFAULTS)')
+    op.execute('ALTER TABLE payouts ALTER COLUMN created_at DROP NOT NULL')
+    op.execute('ALTER TABLE payouts ADD CONSTRAINT payouts_legacy_pkey PRIMARY KEY (id)')
+    op.execute('ALTER SEQUENCE payouts_id_seq OWNED BY payouts.id')
+    op.execute('INSERT INTO payouts SELECT * FROM payouts_partitioned')
+    op.execute('DROP TABLE payouts_partitioned CASCADE')
+    op.execute('ALTER TABLE payouts RENAME CONSTRAINT payouts_legacy_pkey TO payouts_pkey')